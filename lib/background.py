@@ -1,26 +1,50 @@
-from queue import Queue
-from threading import Thread
-from typing import Optional
+import json
+import os
+from email.message import Message
+from threading import Thread, Lock
+from time import monotonic
+from typing import Optional, Dict, Iterable, List, Tuple, Callable
 from urllib.parse import urlparse
 from uuid import uuid4
 
-from .common import Job, CustomException, logger, JobStatus, merge_int_iterables
-from .data import DataDownloader, DataReader, DataWriter, DataSorter
+from .cache import ResultCache, hash_file, get_result_paths
+from .cluster import ClusterSorter
+from .common import Job, CustomException, logger, JobStatus, unique_sorted, ServiceUnavailable, StreamInterrupted, \
+    STREAM_POLL_INTERVAL
+from .data import Downloader, DataReader, DataWriter, DataSorterFactory, ExternalSorter, DataPipeline, ChunkSizer, \
+    get_version
+from .metrics import Metrics, JobTimings, track_job
+from .query import Query, parse_query, parse_unique
+from .scheduler import JobScheduler, PRIORITIES
+from .store import JobStore
+
+
+STREAM_BLOCK_SIZE = 65536
 
 
 class ValidatedJob:
 
     @classmethod
-    def create_from(cls, job: Job):
-        return cls(job.id, int(job.concurrency), job.url)
+    def create_from(cls, job: Job, query: Query=None, unique: bool=False):
+        return cls(job.id, int(job.concurrency), job.url, query, unique, job.headers)
 
-    def __init__(self, job_id: str, concurrency: int, url: str):
+    def __init__(self, job_id: str, concurrency: int, url: str, query: Query=None, unique: bool=False,
+                 headers: Optional[Message]=None):
         self.id = job_id
         self.concurrency = concurrency
         self.url = url
+        self.query = query
+        self.unique = unique
+        self.headers = headers
+
+    @property
+    def cache_key(self) -> str:
+        key = '%s#%s' % (self.url, self.query) if self.query else self.url
+        return key + '#unique' if self.unique else key
 
     def __str__(self):
-        return '%s(id=%s, concurrency=%s, url=%s)' % (self.__class__.__name__, self.id, self.concurrency, self.url)
+        return '%s(id=%s, concurrency=%s, url=%s, query=%s, unique=%s)' % (
+            self.__class__.__name__, self.id, self.concurrency, self.url, self.query, self.unique)
 
 
 class JobValidator:
@@ -31,7 +55,8 @@ class JobValidator:
     def validate(self, job: Job) -> ValidatedJob:
         self._validate_concurrency(job.concurrency)
         self._validate_url(job.url)
-        return ValidatedJob.create_from(job)
+        self._validate_priority(job.priority)
+        return ValidatedJob.create_from(job, parse_query(job.query), parse_unique(job.query))
 
     def _validate_concurrency(self, concurrency: str):
         try:
@@ -51,78 +76,345 @@ class JobValidator:
         if result.scheme != 'http':
             raise CustomException('URL must be a HTTP resource')
 
+    def _validate_priority(self, priority: str):
+        if priority not in PRIORITIES:
+            raise CustomException('priority must be one of %s' % ', '.join(PRIORITIES))
 
-class BackgroundMaster:
 
-    def __init__(self, validator: JobValidator, downloader: DataDownloader, reader: DataReader, writer: DataWriter):
-        self._queue = Queue()
-        self._jobs = {}
-        self._workers = []
-        self._validator = validator
+class JobProcessor:
+
+    def __init__(self, downloader: Downloader, reader: DataReader, writer: DataWriter,
+                 sorter_factory: DataSorterFactory, external_sorter: ExternalSorter=None,
+                 pipeline: DataPipeline=None, cache: ResultCache=None, cluster: ClusterSorter=None):
         self._downloader = downloader
         self._reader = reader
         self._writer = writer
+        self._sorter_factory = sorter_factory
+        self._external_sorter = external_sorter
+        self._pipeline = pipeline
+        self._cache = cache
+        self._cluster = cluster
+
+    def process(self, job: ValidatedJob) -> str:
+        if self._cache and job.headers is None:
+            job.headers = self._downloader.head(job.url)
+        version = self._cache and get_version(job.headers)
+        if version:
+            path = self._cache.get(job.cache_key, version)
+            if path:
+                logger.info('Job %s is served from cache: %s', job.id, path)
+                return path
+        name = '%s.raw' % job.id
+        if self._pipeline:
+            sizer = self._create_chunk_sizer(None)
+            chunks = self._pipeline.read(job.url, name, sizer)
+        else:
+            self._downloader.download_url(job.url, name, job.headers)
+            if self._cache and not version:
+                version = hash_file(os.path.join(self._reader.work_dir, name))
+                path = self._cache.get(job.cache_key, version)
+                if path:
+                    logger.info('Job %s is served from cache: %s', job.id, path)
+                    return path
+            sizer = self._create_chunk_sizer(os.path.getsize(os.path.join(self._reader.work_dir, name)))
+            chunks = self._reader.read(name, sizer)
+        if job.query:
+            path = self._select(job, chunks, sizer)
+        elif self._cluster:
+            sorted_numbers = self._cluster.sort(job.id, chunks, job.concurrency)
+            if job.unique:
+                sorted_numbers = unique_sorted(sorted_numbers)
+            path = self._writer.write('%s.json' % job.id, sorted_numbers)
+            logger.info('Job %s was sorted on %s peers', job.id, len(self._cluster.peers))
+        else:
+            path = self._sort(job, chunks, sizer)
+        if version:
+            self._cache.put(job.cache_key, version, path)
+        return path
+
+    def _create_chunk_sizer(self, total_size: Optional[int]) -> ChunkSizer:
+        memory = self._external_sorter and self._external_sorter.max_memory
+        return ChunkSizer(total_size, self._sorter_factory.workers, memory)
+
+    def _sort(self, job: ValidatedJob, chunks: Iterable[Iterable[int]], sizer: ChunkSizer) -> str:
+        with self._sorter_factory.create(job.concurrency, sizer) as sorter:
+            if self._external_sorter:
+                sorted_numbers = self._external_sorter.sort(job.id, chunks, sorter)
+            else:
+                sorted_numbers = sorter.sort_all(chunks)
+            if job.unique:
+                sorted_numbers = unique_sorted(sorted_numbers)
+            path = self._writer.write('%s.json' % job.id, sorted_numbers)
+            logger.info('Job %s was sorted with %s kernel', job.id, sorter.kernel.name)
+        return path
+
+    def _select(self, job: ValidatedJob, chunks: Iterable[Iterable[int]], sizer: ChunkSizer) -> str:
+        with self._sorter_factory.create(job.concurrency, sizer) as sorter:
+            selected = job.query.select(job.id, chunks, sorter, job.unique, self._external_sorter)
+            path = self._writer.write('%s.json' % job.id, selected)
+        logger.info('Job %s was answered with %s', job.id, job.query)
+        return path
+
+    def get_partial_path(self, job_id: str) -> str:
+        return os.path.join(self._reader.work_dir, '%s.json' % job_id)
+
+    def get_cache_stats(self) -> Optional[dict]:
+        if not self._cache:
+            return None
+        return dict(hits=self._cache.hits, misses=self._cache.misses)
+
+    def cleanup(self, job_id: str, status: JobStatus):
+        paths = [os.path.join(self._reader.work_dir, '%s.raw' % job_id)]
+        if status.has_file_path() and not (self._cache and self._cache.contains(status.data)):
+            paths.extend(get_result_paths(status.data))
+        for path in paths:
+            if os.path.exists(path):
+                logger.debug('Removing expired file %s', path)
+                os.remove(path)
+
+
+class JobCoalescer:
+
+    def __init__(self):
+        self._jobs: Dict[str, Job] = {}
+        self._lock = Lock()
+
+    def attach(self, job: Job, statuses: JobStore) -> Optional[Job]:
+        key = self._make_key(job)
+        with self._lock:
+            leader = self._jobs.get(key)
+            if leader:
+                leader.followers.append(job.id)
+                statuses[job.id] = statuses[leader.id]
+                return leader
+            self._jobs[key] = job
+            return None
+
+    def set_status(self, job: Job, status: JobStatus, statuses: JobStore):
+        key = self._make_key(job)
+        with self._lock:
+            if status.is_final() and self._jobs.get(key) is job:
+                del self._jobs[key]
+            for job_id in [job.id] + job.followers:
+                statuses[job_id] = status
+
+    def _make_key(self, job: Job) -> str:
+        return '%s#%s#%s' % (job.concurrency, job.url, sorted(job.query.items()))
+
+
+class BackgroundMaster:
+
+    def __init__(self, validator: JobValidator, processor: JobProcessor, jobs: JobStore, scheduler: JobScheduler,
+                 coalescer: JobCoalescer=None, metrics: Metrics=None):
+        self._scheduler = scheduler
+        self._jobs = jobs
+        self._workers = []
+        self._validator = validator
+        self._processor = processor
+        self._coalescer = coalescer
+        self._metrics = metrics
+        self._running: Dict[str, JobTimings] = {}
+        self._pending: Dict[str, Job] = {}
+        self._draining = False
+        self._stopped = False
+        self._lock = Lock()
 
     def start(self, worker_count: int):
         logger.info('Starting background master with %s workers', worker_count)
         for _ in range(worker_count):
-            worker = BackgroundWorker(self._validator, self._downloader, self._reader, self._writer, self._queue,
-                                      self._jobs)
+            worker = BackgroundWorker(self._validator, self._processor, self._coalescer, self._scheduler, self._jobs,
+                                      self._metrics, self._running, self._pending)
             worker.start()
             self._workers.append(worker)
 
     def stop(self):
         logger.info('Stopping background master')
+        self._stopped = True
         for _ in self._workers:
-            self._queue.put(None)
+            self._scheduler.put(None)
+        self._scheduler.stop()
+
+    def add_job(self, concurrency: str, url: str, priority: str='normal', client: str=None,
+                query: Dict[str, str]=None) -> str:
+        job = Job(str(uuid4()), concurrency, url, priority, client, query)
+        self._submit(job)
+        return job.id
+
+    def add_jobs(self, items: List[Tuple[str, str, str, Optional[Dict[str, str]]]], client: str=None) -> List[str]:
+        jobs = [Job(str(uuid4()), concurrency, url, priority, client, query)
+                for concurrency, url, priority, query in items]
+        self._submit(*jobs)
+        return [job.id for job in jobs]
+
+    def drain(self, timeout: float, path: str=None) -> bool:
+        with self._lock:
+            if self._draining:
+                return False
+            self._draining = True
+        queued = self._scheduler.drain()
+        logger.info('Draining: %s queued jobs are held back, waiting up to %s seconds for %s running jobs',
+                    len(queued), timeout, len(self._running))
+        deadline = monotonic() + timeout
+        for worker in self._workers:
+            worker.join(max(deadline - monotonic(), 0))
+        with self._lock:
+            jobs = list(self._pending.values())
+        if not path:
+            logger.warning('Dropping %s unfinished jobs, there is no work directory to keep them', len(jobs))
+            return True
+        self._save_jobs(path, jobs)
+        return True
+
+    def resume(self, path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        with open(path) as file:
+            items = json.load(file)
+        os.remove(path)
+        for item in items:
+            self._submit(Job.from_dict(item))
+        logger.info('Resumed %s jobs from %s', len(items), path)
+        return len(items)
+
+    def _submit(self, *jobs: Job):
+        with self._lock:
+            if self._draining:
+                raise ServiceUnavailable('server is draining')
+            accepted = [job for job in jobs if self._accept(job)]
+        for job in accepted:
+            logger.debug('Adding job %s', job)
+            self._scheduler.put(job)
+
+    def _accept(self, job: Job) -> bool:
+        try:
+            self._validator.validate(job)
+        except CustomException as e:
+            logger.debug('Rejecting job %s: %s', job, e)
+            self._jobs[job.id] = JobStatus.error(str(e))
+            return False
+        self._jobs[job.id] = JobStatus.queued()
+        leader = self._coalescer and self._coalescer.attach(job, self._jobs)
+        if leader:
+            logger.debug('Coalescing job %s with %s', job, leader)
+            return False
+        self._pending[job.id] = job
+        return True
 
-    def add_job(self, concurrency: str, url: str) -> str:
-        job_id = str(uuid4())
-        job = Job(job_id, concurrency, url)
-        logger.debug('Adding job %s', job)
-        self._queue.put(job)
-        self._jobs[job_id] = JobStatus.queued()
-        return job_id
+    def _save_jobs(self, path: str, jobs: List[Job]):
+        items = []
+        for job in jobs:
+            items.append(job.to_dict())
+            items.extend(dict(job.to_dict(), id=follower) for follower in job.followers)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(items, file)
+        os.replace(path + '.tmp', path)
+        logger.info('Saved %s unfinished jobs into %s', len(items), path)
 
-    def get_job_status(self, job_id: str) -> Optional[JobStatus]:
-        return self._jobs.get(job_id)
+    def get_job_status(self, job_id: str, wait: float=0) -> Optional[JobStatus]:
+        status = self._jobs.wait(job_id, wait) if wait > 0 else self._jobs.get(job_id)
+        if status and status.has_file_path() and not os.path.exists(status.data):
+            return JobStatus.error('result expired')
+        timings = status and status.state == JobStatus.STATE_PROGRESS and self._running.get(job_id)
+        if timings:
+            return JobStatus(status.state, status.data, completion=timings.get_progress())
+        return status
+
+    def watch_job(self, job_id: str, callback: Callable[[], None]) -> Callable[[], None]:
+        return self._jobs.watch(job_id, callback)
+
+    def stream_result(self, job_id: str, blocking: bool=True) -> Optional[Iterable[bytes]]:
+        status = self._jobs.get(job_id)
+        if not status or status.state == JobStatus.STATE_ERROR:
+            return None
+        return self._tail_result(job_id, blocking)
+
+    def _tail_result(self, job_id: str, blocking: bool) -> Iterable[bytes]:
+        file = None
+        try:
+            while True:
+                status = self._jobs.get(job_id)
+                if not status or status.state == JobStatus.STATE_ERROR or self._stopped:
+                    logger.debug('Interrupting result stream of job %s in state %s', job_id, status and status.state)
+                    raise StreamInterrupted('job %s is not going to finish' % job_id)
+                if file is None:
+                    path = status.data if status.has_file_path() else self._processor.get_partial_path(job_id)
+                    if os.path.exists(path):
+                        file = open(path, 'rb')
+                if file:
+                    data = file.read(STREAM_BLOCK_SIZE)
+                    if data:
+                        yield data
+                        continue
+                    if status.has_file_path():
+                        return
+                if blocking:
+                    self._jobs.wait(job_id, STREAM_POLL_INTERVAL)
+                else:
+                    yield b''
+        finally:
+            if file:
+                file.close()
+
+    def get_stats(self) -> dict:
+        return dict(jobs=len(self._jobs), lanes=self._scheduler.get_depths(), cache=self._processor.get_cache_stats(),
+                    draining=int(self._draining))
+
+    def get_metrics(self) -> str:
+        return (self._metrics or Metrics()).render(self.get_stats())
 
 
 class BackgroundWorker:
 
-    def __init__(self, validator: JobValidator, downloader: DataDownloader, reader: DataReader, writer: DataWriter,
-                 queue: Queue, jobs: dict):
+    def __init__(self, validator: JobValidator, processor: JobProcessor, coalescer: Optional[JobCoalescer],
+                 scheduler: JobScheduler, jobs: JobStore, metrics: Metrics=None, running: Dict[str, JobTimings]=None,
+                 pending: Dict[str, Job]=None):
         self._validator = validator
-        self._downloader = downloader
-        self._reader = reader
-        self._writer = writer
-        self._queue = queue
+        self._processor = processor
+        self._coalescer = coalescer
+        self._scheduler = scheduler
         self._jobs = jobs
+        self._metrics = metrics
+        self._running = {} if running is None else running
+        self._pending = {} if pending is None else pending
+        self._thread = Thread(target=self._run, daemon=True)
 
     def start(self):
         logger.info('Starting background worker %s', self)
-        Thread(target=self._run).start()
+        self._thread.start()
+
+    def join(self, timeout: float):
+        self._thread.join(timeout)
 
     def _run(self):
         while True:
-            job = self._queue.get()
+            job = self._scheduler.get()
             if job is None:
                 logger.debug('Closing background worker %s', self)
                 break
             logger.debug('Got job %s, processing on %s', job, self)
+            timings = JobTimings()
+            timings.add('queue', monotonic() - job.created_at)
+            self._running[job.id] = timings
             try:
-                self._jobs[job.id] = JobStatus.progress()
+                self._set_status(job, JobStatus.progress())
                 validated_job = self._validator.validate(job)
-                path = self._process_job(validated_job)
-                self._jobs[job.id] = JobStatus.ready(path)
+                with track_job(timings):
+                    path = self._processor.process(validated_job)
+                status = JobStatus.ready(path, timings.to_dict())
             except Exception as e:
                 logger.exception('Cannot process job %s: %s', job, e)
-                self._jobs[job.id] = JobStatus.error(str(e) if isinstance(e, CustomException) else 'unexpected error')
+                message = str(e) if isinstance(e, CustomException) else 'unexpected error'
+                status = JobStatus.error(message, timings.to_dict())
+            finally:
+                self._running.pop(job.id, None)
+            logger.debug('Job %s timings: %s', job, status.timings)
+            if self._metrics:
+                self._metrics.observe_job(timings, status.state)
+            self._set_status(job, status)
+            self._pending.pop(job.id, None)
 
-    def _process_job(self, job: ValidatedJob) -> str:
-        name = '%s.raw' % job.id
-        self._downloader.download_url(job.url, name)
-        with DataSorter(job.concurrency) as sorter:
-            sorted_numbers = merge_int_iterables(sorter.sort(numbers) for numbers in self._reader.read(name))
-            path = self._writer.write('%s.json' % job.id, sorted_numbers)
-        return path
+    def _set_status(self, job: Job, status: JobStatus):
+        if self._coalescer:
+            self._coalescer.set_status(job, status, self._jobs)
+        else:
+            self._jobs[job.id] = status
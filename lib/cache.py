@@ -0,0 +1,81 @@
+import hashlib
+import os
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional, Dict, Tuple, List
+
+from .common import logger, RESULT_FORMATS, get_result_path, get_compressed_path
+
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while True:
+            block = file.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return 'sha256:%s' % digest.hexdigest()
+
+
+def get_result_paths(path: str) -> List[str]:
+    paths = [get_result_path(path, format_name) for format_name in RESULT_FORMATS]
+    return [result_path for result_path in paths + list(map(get_compressed_path, paths)) if os.path.exists(result_path)]
+
+
+class ResultCache:
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._entries: Dict[str, Tuple[str, int]] = OrderedDict()
+        self._paths = set()
+        self._size = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url: str, version: str) -> Optional[str]:
+        key = self._make_key(url, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and os.path.exists(entry[0]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                logger.debug('Cache hit for %s (%s hits, %s misses)', key, self.hits, self.misses)
+                return entry[0]
+            if entry:
+                self._remove(key)
+            self.misses += 1
+            logger.debug('Cache miss for %s (%s hits, %s misses)', key, self.hits, self.misses)
+            return None
+
+    def put(self, url: str, version: str, path: str):
+        key = self._make_key(url, version)
+        size = sum(map(os.path.getsize, get_result_paths(path)))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = path, size
+            self._paths.add(path)
+            self._size += size
+            while self._size > self._max_size and len(self._entries) > 1:
+                evicted_key = next(iter(self._entries))
+                logger.info('Evicting %s from result cache', evicted_key)
+                for result_path in get_result_paths(self._entries[evicted_key][0]):
+                    os.remove(result_path)
+                self._remove(evicted_key)
+
+    def contains(self, path: str) -> bool:
+        with self._lock:
+            return path in self._paths
+
+    def _remove(self, key: str):
+        path, size = self._entries.pop(key)
+        self._paths.discard(path)
+        self._size -= size
+
+    def _make_key(self, url: str, version: str) -> str:
+        return '%s#%s' % (url, version)
@@ -0,0 +1,186 @@
+import json
+import os
+import sys
+from array import array
+from bisect import bisect_right
+from itertools import chain
+from random import Random
+from threading import Lock
+from time import sleep
+from typing import Iterable, List, Optional, IO, Set
+from urllib.error import HTTPError, URLError
+from urllib.parse import quote
+from urllib.request import urlopen
+
+from .common import logger, CustomException, RESULT_FORMATS
+
+
+SAMPLES_PER_PEER = 128
+PARTITION_BATCH_SIZE = 65536
+PEER_TIMEOUT = 60
+PEER_POLL_INTERVAL = 0.2
+RESULT_BLOCK_SIZE = 65536
+NUMBER_SIZE = array('q').itemsize
+
+
+def choose_splitters(sample: List[int], count: int) -> List[int]:
+    sample = sorted(sample)
+    if not sample:
+        return []
+    return [sample[len(sample) * i // count] for i in range(1, count)]
+
+
+class ClusterSorter:
+
+    def __init__(self, work_dir: str, peers: List[str], advertise_url: str, poll_interval: float=PEER_POLL_INTERVAL):
+        self._work_dir = work_dir
+        self._peers = [peer.rstrip('/') for peer in peers]
+        self._advertise_url = advertise_url.rstrip('/')
+        self._poll_interval = poll_interval
+        self._partitions: Set[str] = set()
+        self._lock = Lock()
+
+    @property
+    def peers(self) -> List[str]:
+        return self._peers
+
+    def get_partition(self, name: str) -> Optional[str]:
+        with self._lock:
+            if name not in self._partitions:
+                return None
+        return os.path.join(self._work_dir, name)
+
+    def sort(self, job_id: str, chunks: Iterable[Iterable[int]], concurrency: int) -> Iterable[int]:
+        names = ['%s.part.%s' % (job_id, index) for index in range(len(self._peers))]
+        spill_path = os.path.join(self._work_dir, '%s.spill' % job_id)
+        with self._lock:
+            self._partitions.update(names)
+        try:
+            total = self._spill(chunks, spill_path)
+            if not total:
+                raise CustomException('data seems empty')
+            splitters = choose_splitters(self._sample(spill_path, total), len(self._peers))
+            sizes = self._partition(self._read_spill(spill_path), splitters, names)
+            os.remove(spill_path)
+            logger.info('Job %s was split into partitions of sizes %s', job_id, sizes)
+            jobs = [(peer, self._submit(peer, name, concurrency))
+                    for peer, name, size in zip(self._peers, names, sizes) if size]
+            yield from chain.from_iterable(self._fetch(peer, peer_job_id) for peer, peer_job_id in jobs)
+        finally:
+            with self._lock:
+                self._partitions.difference_update(names)
+            for path in [spill_path] + [os.path.join(self._work_dir, name) for name in names]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    @staticmethod
+    def _spill(chunks: Iterable[Iterable[int]], path: str) -> int:
+        total = 0
+        with open(path, 'wb') as file:
+            for numbers in chunks:
+                numbers = numbers if isinstance(numbers, array) else array('q', numbers)
+                numbers.tofile(file)
+                total += len(numbers)
+        return total
+
+    def _sample(self, path: str, total: int) -> List[int]:
+        random = Random(total)
+        indexes = sorted(random.sample(range(total), min(total, SAMPLES_PER_PEER * len(self._peers))))
+        sample = array('q')
+        with open(path, 'rb') as file:
+            for index in indexes:
+                file.seek(index * NUMBER_SIZE)
+                sample.frombytes(file.read(NUMBER_SIZE))
+        return sample.tolist()
+
+    @staticmethod
+    def _read_spill(path: str) -> Iterable[array]:
+        with open(path, 'rb') as file:
+            while True:
+                numbers = array('q', file.read(PARTITION_BATCH_SIZE * NUMBER_SIZE))
+                if not numbers:
+                    break
+                yield numbers
+
+    def _partition(self, chunks: Iterable[Iterable[int]], splitters: List[int], names: List[str]) -> List[int]:
+        files = [open(os.path.join(self._work_dir, name), 'wb') for name in names]
+        buckets: List[List[int]] = [[] for _ in names]
+        sizes = [0] * len(names)
+        try:
+            for numbers in chunks:
+                for number in numbers:
+                    buckets[bisect_right(splitters, number)].append(number)
+                for index, bucket in enumerate(buckets):
+                    if len(bucket) >= PARTITION_BATCH_SIZE:
+                        self._flush(files[index], bucket, sizes[index])
+                        sizes[index] += len(bucket)
+                        bucket.clear()
+            for index, bucket in enumerate(buckets):
+                self._flush(files[index], bucket, sizes[index])
+                sizes[index] += len(bucket)
+        finally:
+            for file in files:
+                file.close()
+        return sizes
+
+    @staticmethod
+    def _flush(file: IO[bytes], bucket: List[int], written: int):
+        if not bucket:
+            return
+        if written:
+            file.write(b',')
+        file.write(','.join(map(str, bucket)).encode())
+
+    def _submit(self, peer: str, name: str, concurrency: int) -> str:
+        url = '%s/?partition=%s' % (self._advertise_url, name)
+        try:
+            with self._open('%s/?concurrency=%s&sort=%s' % (peer, concurrency, quote(url, safe=''))) as response:
+                peer_job_id = json.load(response)['jobid']
+        except HTTPError as e:
+            logger.warning('Peer %s rejected partition %s: %s', peer, name, e)
+            raise CustomException('peer is unavailable')
+        logger.debug('Partition %s was submitted to %s as job %s', name, peer, peer_job_id)
+        return peer_job_id
+
+    def _fetch(self, peer: str, peer_job_id: str) -> Iterable[int]:
+        while True:
+            try:
+                response = self._open('%s/?get=%s&format=int64' % (peer, peer_job_id))
+            except HTTPError as e:
+                if e.code != 406:
+                    raise CustomException('peer %s lost job %s' % (peer, peer_job_id))
+                with self._open('%s/?get=%s&format=json' % (peer, peer_job_id)) as response:
+                    yield from json.load(response)['data']
+                return
+            with response:
+                if response.headers.get_content_type() == RESULT_FORMATS['int64'][1]:
+                    yield from self._read_int64(response)
+                    return
+                payload = json.load(response)
+            if payload['state'] == 'error':
+                raise CustomException('peer %s failed: %s' % (peer, payload['data']))
+            sleep(self._poll_interval)
+
+    @staticmethod
+    def _read_int64(response: IO[bytes]) -> Iterable[int]:
+        tail = b''
+        while True:
+            block = response.read(RESULT_BLOCK_SIZE)
+            if not block:
+                break
+            block = tail + block
+            cut = len(block) - len(block) % 8
+            numbers = array('q', block[:cut])
+            if sys.byteorder == 'big':
+                numbers.byteswap()
+            yield from numbers
+            tail = block[cut:]
+
+    def _open(self, url: str):
+        try:
+            return urlopen(url, timeout=PEER_TIMEOUT)
+        except HTTPError:
+            raise
+        except (URLError, OSError) as e:
+            logger.warning('Cannot reach peer with %s: %s', url, e)
+            raise CustomException('peer is unavailable')
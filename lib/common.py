@@ -1,22 +1,66 @@
 import logging
+import os
+from collections import Counter
+from email.message import Message
+from heapq import heapify, heappop, heapreplace
+from itertools import repeat, groupby
+from operator import itemgetter
 from random import randint
-from typing import Iterable, List
+from time import monotonic
+from typing import Iterable, List, MutableSequence, Sequence, Union, Tuple, Optional, Dict
 
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s [%(levelname)s]: %(message)s')
 logger = logging.getLogger(__name__)
 
+INSERTION_SORT_SIZE = 16
+KERNEL_SAMPLE_SIZE = 1024
+COUNTING_SORT_MIN_SIZE = 4096
+COUNTING_SORT_RANGE_RATIO = 4
+
+RESULT_FORMATS = {
+    'json': ('.json', 'application/json'),
+    'int64': ('.i64', 'application/x-int64-le'),
+    'delta': ('.delta', 'application/x-delta-varint'),
+}
+COMPRESSED_SUFFIX = '.gz'
+STREAM_POLL_INTERVAL = 0.05
+
 
 class CustomException(Exception):
     pass
 
 
+class ServiceUnavailable(CustomException):
+    pass
+
+
+class StreamInterrupted(CustomException):
+    pass
+
+
 class Job:
 
-    def __init__(self, job_id: str, concurrency: str, url: str):
+    def __init__(self, job_id: str, concurrency: str, url: str, priority: str='normal', client: str=None,
+                 query: Dict[str, str]=None):
         self.id = job_id
         self.concurrency = concurrency
         self.url = url
+        self.priority = priority
+        self.client = client
+        self.query = query or {}
+        self.followers: List[str] = []
+        self.headers: Optional[Message] = None
+        self.created_at = monotonic()
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Job':
+        return cls(data['id'], data['concurrency'], data['url'], data.get('priority', 'normal'), data.get('client'),
+                   data.get('query'))
+
+    def to_dict(self) -> dict:
+        return dict(id=self.id, concurrency=self.concurrency, url=self.url, priority=self.priority,
+                    client=self.client, query=self.query)
 
     def __str__(self):
         return '%s(id=%s, concurrency=%s, url=%s)' % (self.__class__.__name__, self.id, self.concurrency, self.url)
@@ -24,6 +68,8 @@ class Job:
 
 class JobStatus:
 
+    __slots__ = ('state', 'data', 'timings', 'completion')
+
     STATE_QUEUED = 'queued'
     STATE_PROGRESS = 'progress'
     STATE_READY = 'ready'
@@ -38,44 +84,175 @@ class JobStatus:
         return JobStatus(cls.STATE_PROGRESS)
 
     @classmethod
-    def ready(cls, path: str):
-        return JobStatus(cls.STATE_READY, path)
+    def ready(cls, path: str, timings: dict=None):
+        return JobStatus(cls.STATE_READY, path, timings)
 
     @classmethod
-    def error(cls, message: str):
-        return JobStatus(cls.STATE_ERROR, message)
+    def error(cls, message: str, timings: dict=None):
+        return JobStatus(cls.STATE_ERROR, message, timings)
 
-    def __init__(self, state: str, data: str=None):
+    def __init__(self, state: str, data: str=None, timings: dict=None, completion: dict=None):
         self.state = state
         self.data = data
+        self.timings = timings
+        self.completion = completion
 
     def has_file_path(self):
         return self.state == self.STATE_READY
 
+    def is_final(self):
+        return self.state in (self.STATE_READY, self.STATE_ERROR)
+
+
+def get_result_path(path: str, format_name: str) -> str:
+    return os.path.splitext(path)[0] + RESULT_FORMATS[format_name][0]
+
+
+def get_compressed_path(path: str) -> str:
+    return path + COMPRESSED_SUFFIX
+
+
+def get_result_format(path: str) -> Optional[str]:
+    extension = os.path.splitext(path)[1]
+    for format_name, (format_extension, _) in RESULT_FORMATS.items():
+        if format_extension == extension:
+            return format_name
+    return None
+
+
+def encode_delta_varint(numbers: Iterable[int], previous: int=0) -> Tuple[bytearray, int]:
+    output = bytearray()
+    append = output.append
+    for number in numbers:
+        delta = number - previous
+        previous = number
+        value = delta << 1 if delta >= 0 else (-delta << 1) - 1
+        while value >= 0x80:
+            append(value & 0x7f | 0x80)
+            value >>= 7
+        append(value)
+    return output, previous
+
+
+def decode_delta_varint(data: bytes) -> List[int]:
+    result = []
+    previous = value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        previous += -((value + 1) >> 1) if value & 1 else value >> 1
+        result.append(previous)
+        value = shift = 0
+    return result
+
 
 def merge_int_iterables(parts: Iterable[Iterable[int]]) -> Iterable[int]:
-    def pair(numbers):
+    heap = []
+    for index, numbers in enumerate(parts):
         iterator = iter(numbers)
-        return [next(iterator), iterator]
-    pairs = list(map(pair, parts))
-    while pairs:
-        min_index = None
-        min_value = float('Inf')
-        for i, (value, _) in enumerate(pairs):
-            if value < min_value:
-                min_index = i
-                min_value = value
-        try:
-            pairs[min_index][0] = next(pairs[min_index][1])
-        except StopIteration:
-            del pairs[min_index]
-        yield min_value
-
-
-def quick_sort(numbers: List[int]) -> List[int]:
-    if len(numbers) <= 1:
-        return numbers
-    pivot = numbers[randint(0, len(numbers) - 1)]
-    head = quick_sort([item for item in numbers if item < pivot])
-    tail = quick_sort([item for item in numbers if item > pivot])
-    return head + [item for item in numbers if item == pivot] + tail
+        for value in iterator:
+            heap.append((value, index, iterator))
+            break
+    heapify(heap)
+    while len(heap) > 1:
+        value, index, iterator = heap[0]
+        yield value
+        for value in iterator:
+            heapreplace(heap, (value, index, iterator))
+            break
+        else:
+            heappop(heap)
+    if heap:
+        value, _, iterator = heap[0]
+        yield value
+        yield from iterator
+
+
+def unique_sorted(numbers: Iterable[int]) -> Iterable[int]:
+    return map(itemgetter(0), groupby(numbers))
+
+
+def quick_sort(numbers: Sequence[int]) -> List[int]:
+    return _quick_sort_in_place(list(numbers))
+
+
+def _quick_sort_in_place(numbers: MutableSequence[int]) -> MutableSequence[int]:
+    stack = [(0, len(numbers) - 1)]
+    while stack:
+        low, high = stack.pop()
+        if high - low < INSERTION_SORT_SIZE:
+            _insertion_sort(numbers, low, high)
+            continue
+        pivot = numbers[randint(low, high)]
+        less, index, greater = low, low, high
+        while index <= greater:
+            value = numbers[index]
+            if value < pivot:
+                numbers[less], numbers[index] = value, numbers[less]
+                less += 1
+                index += 1
+            elif value > pivot:
+                numbers[greater], numbers[index] = value, numbers[greater]
+                greater -= 1
+            else:
+                index += 1
+        if less - low > high - greater:
+            stack.append((low, less - 1))
+            stack.append((greater + 1, high))
+        else:
+            stack.append((greater + 1, high))
+            stack.append((low, less - 1))
+    return numbers
+
+
+def _insertion_sort(numbers: MutableSequence[int], low: int, high: int):
+    for i in range(low + 1, high + 1):
+        value = numbers[i]
+        j = i - 1
+        while j >= low and numbers[j] > value:
+            numbers[j + 1] = numbers[j]
+            j -= 1
+        numbers[j + 1] = value
+
+
+class InPlaceSortKernel:
+
+    name = 'inplace'
+
+    def sort(self, numbers: MutableSequence[int]) -> MutableSequence[int]:
+        return _quick_sort_in_place(numbers)
+
+
+class TimSortKernel:
+
+    name = 'timsort'
+
+    def sort(self, numbers: Sequence[int]) -> List[int]:
+        return sorted(numbers)
+
+
+class CountingSortKernel:
+
+    name = 'counting'
+
+    def sort(self, numbers: Sequence[int]) -> List[int]:
+        counts = Counter(numbers)
+        result = []
+        for value in sorted(counts):
+            result.extend(repeat(value, counts[value]))
+        return result
+
+
+SortKernel = Union[InPlaceSortKernel, TimSortKernel, CountingSortKernel]
+SORT_KERNELS = dict((kernel.name, kernel) for kernel in (InPlaceSortKernel(), TimSortKernel(), CountingSortKernel()))
+
+
+def choose_sort_kernel(numbers: Sequence[int]) -> SortKernel:
+    if len(numbers) < COUNTING_SORT_MIN_SIZE:
+        return SORT_KERNELS[TimSortKernel.name]
+    sample = [numbers[randint(0, len(numbers) - 1)] for _ in range(KERNEL_SAMPLE_SIZE)]
+    if max(sample) - min(sample) <= len(numbers) // COUNTING_SORT_RANGE_RATIO:
+        return SORT_KERNELS[CountingSortKernel.name]
+    return SORT_KERNELS[TimSortKernel.name]
@@ -1,160 +1,951 @@
+import gzip
+import io
+import mmap
 import os
+import sys
+import zlib
+from abc import ABC, abstractmethod
+from array import array
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from contextlib import contextmanager, ExitStack
+from email.message import Message
+from functools import partial
+from http.client import HTTPConnection, HTTPResponse, HTTPException
+from itertools import islice, chain
 from math import ceil
+from multiprocessing import get_context
 from multiprocessing.pool import Pool
-from queue import Queue
-from shutil import copyfileobj
-from threading import Thread
-from typing import Optional, Iterable, List, IO
+from queue import Queue, Empty, Full
+from threading import Thread, Lock, Event
+from time import perf_counter
+from typing import Optional, Iterable, List, IO, Union, Callable, Dict, Tuple, Any, Sequence, Iterator
 from urllib.error import HTTPError
-from urllib.request import urlopen
+from urllib.parse import urlparse
+from urllib.request import urlopen, Request
+
+from .common import logger, CustomException, merge_int_iterables, SortKernel, SORT_KERNELS, choose_sort_kernel, \
+    get_result_path, get_compressed_path, encode_delta_varint
+from .metrics import stage, count, expect, get_job_timings, JobTimings
+
+
+BUFFER_SIZE = 1024 * 1024
+DATA_SEPARATOR = b','
+RUN_BUFFER_SIZE = 8192
+NUMBER_MEMORY_FOOTPRINT = 64
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_BLOCK_SIZE = 65536
+RANGE_SEGMENT_SIZE = 4 * 1024 * 1024
+PIPELINE_QUEUE_SIZE = 16
+PIPELINE_POLL_INTERVAL = 0.1
+WRITE_BATCH_SIZE = 65536
+WRITE_BUFFER_SIZE = 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+TARGET_CHUNK_COUNT = 8
+MAX_MERGE_WIDTH = 64
+CHUNK_MEMORY_RATIO = 8
+MIN_PART_LENGTH = 16384
+TARGET_PART_SECONDS = 0.1
+MERGE_MEMORY_RATIO = 2
+MERGE_NUMBER_FOOTPRINT = 48
+ACCEPT_ENCODING = 'gzip, deflate'
+CONTENT_ENCODINGS = {'gzip': 16 + zlib.MAX_WBITS, 'x-gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+GZIP_LEVEL = 6
+POOL_START_METHOD = 'forkserver'
+
+
+class ContentDecoder:
+
+    @classmethod
+    def create(cls, encoding: Optional[str]) -> Optional['ContentDecoder']:
+        if not encoding or encoding.strip().lower() == 'identity':
+            return None
+        return cls(encoding)
+
+    def __init__(self, encoding: str):
+        wbits = CONTENT_ENCODINGS.get(encoding.strip().lower())
+        if wbits is None:
+            raise CustomException('unsupported content encoding %s' % encoding)
+        self._decompressor = zlib.decompressobj(wbits)
+
+    def decode(self, block: bytes) -> bytes:
+        try:
+            return self._decompressor.decompress(block)
+        except zlib.error as e:
+            logger.debug('Cannot decode data: %s', e)
+            raise CustomException('incorrect data')
+
+    def flush(self) -> bytes:
+        block = self.decode(b'') + self._decompressor.flush()
+        if not self._decompressor.eof:
+            raise CustomException('incorrect data')
+        return block
+
+
+def read_response(response: IO[bytes]) -> Iterable[bytes]:
+    decoder = ContentDecoder.create(response.headers.get('Content-Encoding'))
+    while True:
+        block = response.read(DOWNLOAD_BLOCK_SIZE)
+        if not block:
+            break
+        if decoder:
+            block = decoder.decode(block)
+        if block:
+            yield block
+    if decoder:
+        block = decoder.flush()
+        if block:
+            yield block
+
+
+def get_version(headers: Message) -> Optional[str]:
+    if headers.get('ETag'):
+        return 'etag:%s' % headers['ETag']
+    if headers.get('Last-Modified'):
+        return 'last-modified:%s' % headers['Last-Modified']
+    return None
+
+
+def get_content_length(headers: Message) -> Optional[int]:
+    size = headers.get('Content-Length')
+    return int(size) if size and size.isdigit() else None
 
-from .common import logger, CustomException, merge_int_iterables, quick_sort
 
+class BaseDownloader(ABC):
 
-BUFFER_SIZE = 10240
-DATA_SEPARATOR = ', '
+    def warm_up(self):
+        pass
 
+    @abstractmethod
+    def head(self, url: str) -> Message:
+        pass
 
-class DataDownloader:
+
+class DataDownloader(BaseDownloader):
 
     def __init__(self, work_dir: str, pool_size: int):
         self._work_dir = work_dir
-        self._pool = Pool(pool_size)
+        self._pool_size = pool_size
+        self._pool: Optional[Pool] = None
+        self._lock = Lock()
+
+    def warm_up(self):
+        self._get_pool()
 
     def stop(self):
         logger.info('Stopping data downloader')
-        self._pool.terminate()
-
-    def download_url(self, url: str, output_name: str):
-        self._pool.apply(self._download_url, (self._work_dir, url, output_name))
+        with self._lock:
+            if self._pool:
+                self._pool.terminate()
+
+    def download_url(self, url: str, output_name: str, headers: Optional[Message]=None):
+        with stage('download'):
+            self._get_pool().apply(self._download_url, (self._work_dir, url, output_name))
+        size = os.path.getsize(os.path.join(self._work_dir, output_name))
+        count('download_bytes', size)
+        expect('download_bytes', size)
+
+    def _get_pool(self) -> Pool:
+        with self._lock:
+            if self._pool is None:
+                logger.info('Starting download pool with %s processes', self._pool_size)
+                self._pool = get_context(POOL_START_METHOD).Pool(self._pool_size)
+            return self._pool
 
     @staticmethod
     def _download_url(work_dir: str, url: str, output_name: str):
         path = os.path.join(work_dir, output_name)
         logger.debug('Downloading URL %s into %s', url, path)
         try:
-            with urlopen(url) as response:
+            with urlopen(Request(url, headers={'Accept-Encoding': ACCEPT_ENCODING})) as response:
                 with open(path, 'wb') as output:
-                    copyfileobj(response, output)
+                    for block in read_response(response):
+                        output.write(block)
+        except HTTPError as e:
+            logger.debug('Cannot download %s: %s', url, e)
+            raise CustomException('remote error')
+        size = os.path.getsize(path)
+        if not size:
+            raise CustomException('data seems empty')
+        logger.debug('Download of %s complete (%s bytes total)', url, size)
+
+    def head(self, url: str) -> Message:
+        try:
+            request = Request(url, headers={'Accept-Encoding': ACCEPT_ENCODING}, method='HEAD')
+            with urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+                return response.headers
+        except (HTTPException, OSError, ValueError) as e:
+            logger.debug('Cannot get headers of %s: %s', url, e)
+            return Message()
+
+    def stream_url(self, url: str, consume: Callable[[bytes], None]):
+        logger.debug('Streaming URL %s', url)
+        try:
+            request = Request(url, headers={'Accept-Encoding': ACCEPT_ENCODING})
+            with urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+                self._consume_response(response, consume)
         except HTTPError as e:
             logger.debug('Cannot download %s: %s', url, e)
             raise CustomException('remote error')
+
+    @staticmethod
+    def _consume_response(response: IO, consume: Callable[[bytes], None]):
+        for block in read_response(response):
+            consume(block)
+
+
+class HttpConnectionPool:
+
+    def __init__(self, max_idle_per_host: int):
+        self._max_idle_per_host = max_idle_per_host
+        self._idle: Dict[Tuple[str, int], List[HTTPConnection]] = defaultdict(list)
+        self._lock = Lock()
+
+    def close(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+    def request(self, url: str, method: str, headers: Dict[str, str], handle: Callable[[HTTPResponse], Any]) -> Any:
+        parsed = urlparse(url)
+        key = parsed.hostname, parsed.port or 80
+        target = parsed.path or '/'
+        if parsed.query:
+            target = '%s?%s' % (target, parsed.query)
+        connection, reused = self._acquire(key)
+        try:
+            try:
+                connection.request(method, target, headers=headers)
+                response = connection.getresponse()
+            except (HTTPException, ConnectionError):
+                if not reused:
+                    raise
+                logger.debug('Reused connection to %s:%s is broken, reconnecting', *key)
+                connection.close()
+                connection.request(method, target, headers=headers)
+                response = connection.getresponse()
+            result = handle(response)
+            response.read()
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+        return result
+
+    def _acquire(self, key: Tuple[str, int]) -> Tuple[HTTPConnection, bool]:
+        with self._lock:
+            if self._idle[key]:
+                return self._idle[key].pop(), True
+        return HTTPConnection(*key, timeout=DOWNLOAD_TIMEOUT), False
+
+    def _release(self, key: Tuple[str, int], connection: HTTPConnection):
+        with self._lock:
+            if len(self._idle[key]) < self._max_idle_per_host:
+                self._idle[key].append(connection)
+                return
+        connection.close()
+
+
+class RangeDataDownloader(BaseDownloader):
+
+    def __init__(self, work_dir: str, connection_count: int):
+        self._work_dir = work_dir
+        self._connections = HttpConnectionPool(connection_count)
+        self._executor = ThreadPoolExecutor(connection_count)
+
+    def stop(self):
+        logger.info('Stopping range data downloader')
+        self._executor.shutdown(wait=False)
+        self._connections.close()
+
+    def download_url(self, url: str, output_name: str, headers: Optional[Message]=None):
+        path = os.path.join(self._work_dir, output_name)
+        logger.debug('Downloading URL %s into %s', url, path)
+        with stage('download'):
+            size, accepts_ranges = self._get_ranges(self.head(url) if headers is None else headers)
+            if accepts_ranges and size >= 2 * RANGE_SEGMENT_SIZE:
+                self._download_ranges(url, path, size)
+            else:
+                self._connections.request(url, 'GET', {'Accept-Encoding': ACCEPT_ENCODING},
+                                          lambda response: self._save_response(url, response, path))
         size = os.path.getsize(path)
         if not size:
             raise CustomException('data seems empty')
+        count('download_bytes', size)
+        expect('download_bytes', size)
         logger.debug('Download of %s complete (%s bytes total)', url, size)
 
+    def head(self, url: str) -> Message:
+        try:
+            return self._connections.request(url, 'HEAD', {'Accept-Encoding': ACCEPT_ENCODING},
+                                             lambda response: response.headers if response.status < 400 else Message())
+        except (HTTPException, OSError, ValueError) as e:
+            logger.debug('Cannot get headers of %s: %s', url, e)
+            return Message()
+
+    def stream_url(self, url: str, consume: Callable[[bytes], None]):
+        logger.debug('Streaming URL %s', url)
+
+        def handle(response: HTTPResponse):
+            self._check_status(response)
+            DataDownloader._consume_response(response, consume)
+        self._connections.request(url, 'GET', {'Accept-Encoding': ACCEPT_ENCODING}, handle)
+
+    def _get_ranges(self, headers: Message) -> Tuple[int, bool]:
+        size = headers.get('Content-Length')
+        accepts_ranges = headers.get('Accept-Ranges') == 'bytes' and not ContentDecoder.create(
+            headers.get('Content-Encoding'))
+        return int(size) if size and size.isdigit() else 0, accepts_ranges
+
+    def _check_status(self, response: HTTPResponse):
+        if response.status >= 400:
+            logger.debug('Cannot download: %s %s', response.status, response.reason)
+            raise CustomException('remote error')
+
+    def _save_response(self, url: str, response: HTTPResponse, path: str):
+        self._check_status(response)
+        with open(path, 'wb') as output:
+            for block in read_response(response):
+                output.write(block)
+
+    def _download_ranges(self, url: str, path: str, size: int):
+        segments = [(offset, min(offset + RANGE_SEGMENT_SIZE, size) - 1)
+                    for offset in range(0, size, RANGE_SEGMENT_SIZE)]
+        logger.debug('Downloading %s in %s ranges', url, len(segments))
+        with open(path, 'wb') as output:
+            output.truncate(size)
+        fd = os.open(path, os.O_WRONLY)
+        futures = []
+        try:
+            futures.extend(self._executor.submit(self._download_segment, url, fd, start, end)
+                           for start, end in segments)
+            for future in futures:
+                future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            os.close(fd)
+
+    def _download_segment(self, url: str, fd: int, start: int, end: int):
+        def handle(response: HTTPResponse):
+            self._check_status(response)
+            if response.status != 206 or not response.getheader('Content-Range', '').startswith('bytes %s-' % start):
+                raise CustomException('remote error')
+            offset = start
+            while True:
+                data = response.read(DOWNLOAD_BLOCK_SIZE)
+                if not data:
+                    break
+                offset += os.pwrite(fd, data, offset)
+            if offset != end + 1:
+                raise CustomException('remote error')
+        self._connections.request(url, 'GET', {'Range': 'bytes=%s-%s' % (start, end)}, handle)
+
+
+Downloader = Union[DataDownloader, RangeDataDownloader]
+
+
+def get_available_memory() -> Optional[int]:
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def expect_numbers(total: int):
+    expect('sorted_numbers', total)
+    expect('written_numbers', total)
+
+
+class ChunkSizer:
+
+    def __init__(self, total_size: Optional[int], workers: int, memory: Optional[int]=None):
+        memory = memory or get_available_memory()
+        self._max_size = MAX_CHUNK_SIZE
+        if memory:
+            self._max_size = min(max(memory // (CHUNK_MEMORY_RATIO * max(workers, 1)), MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+        self._remaining = total_size
+        self._chunks = 0
+        self._size = self._clip(total_size // TARGET_CHUNK_COUNT if total_size else BUFFER_SIZE)
+        self._lock = Lock()
+        self.max_merge_length = (memory or 0) // (MERGE_MEMORY_RATIO * MERGE_NUMBER_FOOTPRINT)
+
+    def _clip(self, size: int) -> int:
+        return min(max(size, MIN_CHUNK_SIZE), self._max_size)
+
+    def next_size(self) -> int:
+        size = self._size
+        if self._remaining is not None:
+            width = MAX_MERGE_WIDTH - self._chunks
+            size = max(size, self._remaining // width) if width > 1 else self._max_size
+        return self._clip(size)
+
+    def consume(self, size: int):
+        self._chunks += 1
+        if self._remaining is not None:
+            self._remaining = max(self._remaining - size, 0)
+
+    def observe(self, seconds: float):
+        with self._lock:
+            if seconds < TARGET_PART_SECONDS / 4:
+                self._size = self._clip(self._size * 2)
+            elif seconds > TARGET_PART_SECONDS * 4:
+                self._size = self._clip(self._size // 2)
+
 
 class DataReader:
 
     def __init__(self, work_dir: str):
         self._work_dir = work_dir
 
-    def read(self, name: str) -> Iterable[List[int]]:
+    @property
+    def work_dir(self) -> str:
+        return self._work_dir
+
+    def read(self, name: str, sizer: ChunkSizer=None) -> Iterable[array]:
         path = os.path.join(self._work_dir, name)
         logger.info('Reading numbers from file %s', path)
-        with open(path) as file:
-            yield from self._read_from_file(file)
-
-    def _read_from_file(self, file: IO, buffer_size=BUFFER_SIZE) -> Iterable[List[int]]:
-        tail = None
+        total = 0
+        with open(path, 'rb') as file:
+            for numbers in self._read_from_file(file, sizer=sizer):
+                total += len(numbers)
+                yield numbers
+        expect_numbers(total)
+
+    def _read_from_file(self, file: IO[bytes], buffer_size=BUFFER_SIZE, sizer: ChunkSizer=None) -> Iterable[array]:
+        buffer = bytearray(buffer_size)
+        tail = b''
+        offset = 0
         while True:
-            chunk = file.read(buffer_size)
-            if tail:
-                chunk = tail + chunk
-            if not chunk:
+            if sizer:
+                buffer_size = sizer.next_size()
+                if len(buffer) != buffer_size:
+                    buffer = bytearray(buffer_size)
+            size = file.readinto(buffer)
+            if not size:
                 break
-            if len(chunk) < buffer_size:
-                head, tail = chunk, None
-            else:
-                parts = chunk.rsplit(DATA_SEPARATOR, 1)
-                if len(parts) == 2:
-                    head, tail = parts
-                else:
-                    head, tail = parts[0], None
+            if sizer:
+                sizer.consume(size)
+            data = tail + buffer[:size]
+            cut = data.rfind(DATA_SEPARATOR)
+            if cut < 0:
+                tail = data
+                continue
+            yield self._parse(data[:cut], offset)
+            offset += cut + 1
+            tail = data[cut + 1:]
+        if tail or offset:
+            yield self._parse(tail, offset)
+
+    def _parse(self, data: bytes, offset: int) -> array:
+        with stage('parse'):
+            try:
+                numbers = array('q', map(int, data.split(DATA_SEPARATOR)))
+            except (ValueError, OverflowError):
+                numbers = None
+        if numbers is not None:
+            count('parsed_numbers', len(numbers))
+            return numbers
+        for token in data.split(DATA_SEPARATOR):
             try:
-                yield list(map(int, head.split(DATA_SEPARATOR)))
-            except ValueError as e:
-                logger.warning('Cannot parse numbers: %s', e)
-                raise CustomException('incorrect data')
+                array('q', (int(token),))
+            except (ValueError, OverflowError) as e:
+                logger.warning('Cannot parse numbers at byte %s: %s', offset, e)
+                break
+            offset += len(token) + 1
+        raise CustomException('incorrect data')
 
 
-class DataSorter:
+class PipelineStopped(Exception):
+    pass
 
-    def __init__(self, concurrency: int):
-        self._workers: List[DataSorterWorker] = []
-        self._concurrency = concurrency
 
-    def __enter__(self):
-        self._start()
-        return self
+class QueueStream(io.RawIOBase):
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self._stop()
+    def __init__(self, blocks: Queue, stopped: Event):
+        self._blocks = blocks
+        self._stopped = stopped
+        self._buffer = b''
+        self._finished = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer:
+            if self._finished:
+                return 0
+            block = get_from_pipeline(self._blocks, self._stopped)
+            if block is None:
+                self._finished = True
+            else:
+                self._buffer = block
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def put_into_pipeline(queue: Queue, item: Any, stopped: Event):
+    while not stopped.is_set():
+        try:
+            queue.put(item, timeout=PIPELINE_POLL_INTERVAL)
+            return
+        except Full:
+            pass
+    raise PipelineStopped()
+
+
+def get_from_pipeline(queue: Queue, stopped: Event) -> Any:
+    while not stopped.is_set():
+        try:
+            item = queue.get(timeout=PIPELINE_POLL_INTERVAL)
+        except Empty:
+            continue
+        if isinstance(item, Exception):
+            raise item
+        return item
+    raise PipelineStopped()
+
+
+class DataPipeline:
+
+    def __init__(self, work_dir: str, downloader: Downloader, reader: DataReader, keep_raw: bool=False):
+        self._work_dir = work_dir
+        self._downloader = downloader
+        self._reader = reader
+        self._keep_raw = keep_raw
+
+    def read(self, url: str, raw_name: str, sizer: ChunkSizer=None) -> Iterable[array]:
+        blocks = Queue(PIPELINE_QUEUE_SIZE)
+        chunks = Queue(PIPELINE_QUEUE_SIZE)
+        stopped = Event()
+        timings = get_job_timings()
+        Thread(target=self._download, args=(url, raw_name, blocks, stopped, timings), daemon=True).start()
+        Thread(target=self._parse, args=(blocks, chunks, stopped, sizer), daemon=True).start()
+        total = 0
+        try:
+            while True:
+                with stage('download'):
+                    numbers = get_from_pipeline(chunks, stopped)
+                if numbers is None:
+                    break
+                count('parsed_numbers', len(numbers))
+                total += len(numbers)
+                yield numbers
+            expect_numbers(total)
+        finally:
+            stopped.set()
+
+    def _download(self, url: str, raw_name: str, blocks: Queue, stopped: Event, timings: JobTimings=None):
+        raw_file = open(os.path.join(self._work_dir, raw_name), 'wb') if self._keep_raw else None
+        size = 0
+
+        def consume(block: bytes):
+            nonlocal size
+            size += len(block)
+            if timings:
+                timings.count('download_bytes', len(block))
+            if raw_file:
+                raw_file.write(block)
+            put_into_pipeline(blocks, block, stopped)
+        try:
+            self._downloader.stream_url(url, consume)
+            if not size:
+                raise CustomException('data seems empty')
+            logger.debug('Streaming of %s complete (%s bytes total)', url, size)
+            if timings:
+                timings.expect('download_bytes', size)
+            put_into_pipeline(blocks, None, stopped)
+        except PipelineStopped:
+            logger.debug('Streaming of %s was stopped', url)
+        except Exception as e:
+            self._fail(blocks, e, stopped)
+        finally:
+            if raw_file:
+                raw_file.close()
+
+    def _parse(self, blocks: Queue, chunks: Queue, stopped: Event, sizer: ChunkSizer=None):
+        try:
+            with io.BufferedReader(QueueStream(blocks, stopped)) as file:
+                for numbers in self._reader._read_from_file(file, sizer=sizer):
+                    put_into_pipeline(chunks, numbers, stopped)
+            put_into_pipeline(chunks, None, stopped)
+        except PipelineStopped:
+            pass
+        except Exception as e:
+            self._fail(chunks, e, stopped)
+
+    def _fail(self, queue: Queue, exception: Exception, stopped: Event):
+        try:
+            put_into_pipeline(queue, exception, stopped)
+        except PipelineStopped:
+            pass
 
-    def _start(self):
-        for _ in range(self._concurrency):
-            worker = DataSorterWorker()
-            worker.start()
-            self._workers.append(worker)
 
-    def _stop(self):
+def to_int_array(numbers: Iterable[int]) -> array:
+    try:
+        return array('q', numbers)
+    except OverflowError:
+        raise CustomException('number is out of range')
+
+
+def _sort_int_array(numbers: array, kernel: SortKernel) -> Tuple[array, float]:
+    started_at = perf_counter()
+    result = kernel.sort(numbers)
+    return result if isinstance(result, array) else array('q', result), perf_counter() - started_at
+
+
+class ThreadSortBackend:
+
+    name = 'threads'
+
+    def __init__(self, worker_count: int):
+        logger.info('Starting thread sort backend with %s threads', worker_count)
+        self.size = worker_count
+        self._tasks = Queue()
+        self._workers = [DataSorterWorker(self._tasks) for _ in range(worker_count)]
         for worker in self._workers:
-            worker.put(None)
+            worker.start()
 
-    def sort(self, numbers: List[int]) -> Iterable[int]:
-        logger.debug('Sorting numbers of length %s', len(numbers))
-        count = int(ceil(len(numbers) / self._concurrency))
-        workers = []
-        for worker, offset in zip(self._workers, range(0, len(numbers), count)):
-            worker.put(numbers[offset:offset + count])
-            workers.append(worker)
-        return merge_int_iterables(worker.get() for worker in workers)
+    def submit(self, numbers: Sequence[int], kernel: SortKernel) -> Future:
+        future = Future()
+        self._tasks.put((numbers, kernel, future))
+        return future
 
+    def warm_up(self):
+        pass
 
-class DataSorterWorker:
+    def stop(self):
+        logger.info('Stopping thread sort backend')
+        for _ in self._workers:
+            self._tasks.put(None)
+
+
+class ProcessSortBackend:
+
+    name = 'processes'
+
+    def __init__(self, pool_size: int):
+        self.size = pool_size
+        self._pool: Optional[Pool] = None
+        self._lock = Lock()
+
+    def submit(self, numbers: Sequence[int], kernel: SortKernel) -> Future:
+        future = Future()
+        self._get_pool().apply_async(_sort_int_array, (to_int_array(numbers), kernel), callback=future.set_result,
+                                     error_callback=future.set_exception)
+        return future
+
+    def warm_up(self):
+        self._get_pool()
+
+    def stop(self):
+        logger.info('Stopping process sort backend')
+        with self._lock:
+            if self._pool:
+                self._pool.terminate()
+
+    def _get_pool(self) -> Pool:
+        with self._lock:
+            if self._pool is None:
+                logger.info('Starting process sort backend with %s processes', self.size)
+                self._pool = get_context(POOL_START_METHOD).Pool(self.size)
+            return self._pool
+
+
+SortBackend = Union[ThreadSortBackend, ProcessSortBackend]
+
+
+class MergeBudget:
 
     def __init__(self):
-        self._input_queue = Queue()
-        self._output_queue = Queue()
+        self._used = 0
+        self._lock = Lock()
+
+    def reserve(self, length: int, limit: int) -> bool:
+        with self._lock:
+            if self._used + length > limit:
+                return False
+            self._used += length
+            return True
+
+    def release(self, length: int):
+        with self._lock:
+            self._used -= length
+
+
+class DataSorterFactory:
+
+    def __init__(self, backend: SortBackend, kernel_name: str=None):
+        self._backend = backend
+        self._kernel = SORT_KERNELS[kernel_name] if kernel_name else None
+        self._merge_budget = MergeBudget()
+
+    @property
+    def workers(self) -> int:
+        return self._backend.size
+
+    def create(self, concurrency: int, sizer: ChunkSizer=None) -> 'DataSorter':
+        return DataSorter(concurrency, self._backend, self._kernel, sizer, self._merge_budget)
+
+
+class DataSorter:
+
+    def __init__(self, concurrency: int, backend: SortBackend=None, kernel: SortKernel=None, sizer: ChunkSizer=None,
+                 merge_budget: MergeBudget=None):
+        self._concurrency = concurrency
+        self._backend = backend
+        self._owns_backend = backend is None
+        self._kernel = kernel
+        self._sizer = sizer
+        self._merge_budget = merge_budget or MergeBudget()
+        self._reserved = 0
+
+    @property
+    def kernel(self) -> Optional[SortKernel]:
+        return self._kernel
+
+    def __enter__(self):
+        if self._owns_backend:
+            self._backend = ThreadSortBackend(self._concurrency)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._merge_budget.release(self._reserved)
+        self._reserved = 0
+        if self._owns_backend:
+            self._backend.stop()
+
+    def sort(self, numbers: Sequence[int]) -> Iterable[int]:
+        return merge_int_iterables(self._wait(future) for future in self._submit(numbers))
+
+    def sort_all(self, chunks: Iterable[Sequence[int]]) -> Iterable[int]:
+        runs = self.sort_runs(chunks)
+        length = sum(map(len, runs))
+        if len(runs) > 1 and self._sizer and self._merge_budget.reserve(length, self._sizer.max_merge_length):
+            self._reserved += length
+            with stage('merge'):
+                return sorted(chain.from_iterable(runs))
+        return merge_int_iterables(runs)
+
+    def sort_runs(self, chunks: Iterable[Sequence[int]]) -> List[array]:
+        futures = []
+        for numbers in chunks:
+            futures.extend(self._submit(numbers))
+        return [self._wait(future) for future in futures]
+
+    def _submit(self, numbers: Sequence[int]) -> List[Future]:
+        logger.debug('Sorting numbers of length %s', len(numbers))
+        if self._kernel is None:
+            self._kernel = choose_sort_kernel(numbers)
+            logger.debug('Chose %s sort kernel for numbers of length %s', self._kernel.name, len(numbers))
+        with stage('sort'):
+            parts = max(min(self._concurrency, self._backend.size, int(ceil(len(numbers) / MIN_PART_LENGTH))), 1)
+            size = max(int(ceil(len(numbers) / parts)), 1)
+            futures = [self._backend.submit(numbers[offset:offset + size], self._kernel)
+                       for offset in range(0, len(numbers), size)]
+        timings = get_job_timings()
+        if self._sizer or timings:
+            for future in futures:
+                future.add_done_callback(partial(self._observe, timings))
+        return futures
+
+    def _observe(self, timings: Optional[JobTimings], future: Future):
+        if future.exception():
+            return
+        numbers, seconds = future.result()
+        if self._sizer:
+            self._sizer.observe(seconds)
+        if timings:
+            timings.count('sorted_numbers', len(numbers))
+
+    @staticmethod
+    def _wait(future: Future) -> array:
+        with stage('sort'):
+            return future.result()[0]
 
-    def put(self, numbers: Optional[List[int]]):
-        self._input_queue.put(numbers)
 
-    def get(self) -> List[int]:
-        return self._output_queue.get()
+class DataSorterWorker:
+
+    def __init__(self, tasks: Queue):
+        self._tasks = tasks
 
     def start(self):
         logger.debug('Starting data sorter worker %s', self)
-        Thread(target=self._run).start()
+        Thread(target=self._run, daemon=True).start()
 
     def _run(self):
         while True:
-            numbers = self._input_queue.get()
-            if numbers is None:
+            task = self._tasks.get()
+            if task is None:
                 logger.debug('Stopping data sorter worker %s', self)
                 break
+            numbers, kernel, future = task
+            if not future.set_running_or_notify_cancel():
+                continue
             try:
-                result = quick_sort(numbers)
+                started_at = perf_counter()
+                result = kernel.sort(numbers)
+                future.set_result((result, perf_counter() - started_at))
             except Exception as e:
                 logger.warning('Cannot sort numbers on %s: %s', self, e)
-                result = None
-            self._output_queue.put(result)
+                future.set_exception(e)
+
+
+class ExternalSorter:
+
+    def __init__(self, work_dir: str, max_memory: int):
+        self._work_dir = work_dir
+        self.max_memory = max_memory
+        self._max_numbers = max(max_memory // NUMBER_MEMORY_FOOTPRINT, RUN_BUFFER_SIZE)
+        self._fan_in = max(max_memory // (RUN_BUFFER_SIZE * NUMBER_MEMORY_FOOTPRINT), 2)
+
+    def sort(self, name: str, chunks: Iterable[array], sorter: DataSorter) -> Iterable[int]:
+        paths = []
+        merged_paths = []
+        try:
+            for path in self._write_runs(name, chunks, sorter):
+                paths.append(path)
+            logger.debug('Got %s sorted runs for %s, merging with fan-in %s', len(paths), name, self._fan_in)
+            generation = 0
+            while len(paths) > self._fan_in:
+                generation += 1
+                merged_paths.clear()
+                for offset in range(0, len(paths), self._fan_in):
+                    group = paths[offset:offset + self._fan_in]
+                    numbers = merge_int_iterables(map(self._read_run, group))
+                    merged_paths.append(self._write_run('%s.%s' % (name, generation), len(merged_paths), numbers))
+                    for path in group:
+                        os.remove(path)
+                paths[:] = merged_paths
+            yield from merge_int_iterables(map(self._read_run, paths))
+        finally:
+            for path in paths + merged_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    @contextmanager
+    def open_runs(self, name: str, chunks: Iterable[array], sorter: DataSorter) -> Iterator[List[Sequence[int]]]:
+        paths = []
+        try:
+            with ExitStack() as stack:
+                runs = []
+                for path in self._write_runs(name, chunks, sorter):
+                    paths.append(path)
+                    runs.append(self._map_run(stack, path))
+                logger.debug('Got %s sorted runs for %s, selecting over mapped files', len(runs), name)
+                yield runs
+        finally:
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _write_runs(self, name: str, chunks: Iterable[array], sorter: DataSorter) -> Iterable[str]:
+        for index, numbers in enumerate(self._collect_runs(chunks)):
+            yield self._write_run(name, index, sorter.sort(numbers))
+
+    @staticmethod
+    def _map_run(stack: ExitStack, path: str) -> memoryview:
+        with open(path, 'rb') as file:
+            mapped = stack.enter_context(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        view = memoryview(mapped)
+        stack.callback(view.release)
+        run = view.cast('q')
+        stack.callback(run.release)
+        return run
+
+    def _collect_runs(self, chunks: Iterable[array]) -> Iterable[array]:
+        run = array('q')
+        for numbers in chunks:
+            run.extend(numbers)
+            if len(run) >= self._max_numbers:
+                yield run
+                run = array('q')
+        if run:
+            yield run
+
+    def _write_run(self, name: str, index: int, numbers: Iterable[int]) -> str:
+        path = os.path.join(self._work_dir, '%s.run.%s' % (name, index))
+        iterator = iter(numbers)
+        with open(path, 'wb') as file:
+            while True:
+                buffer = to_int_array(islice(iterator, RUN_BUFFER_SIZE))
+                if not buffer:
+                    break
+                buffer.tofile(file)
+        return path
+
+    def _read_run(self, path: str) -> Iterable[int]:
+        with open(path, 'rb') as file:
+            while True:
+                data = file.read(RUN_BUFFER_SIZE * 8)
+                if not data:
+                    break
+                buffer = array('q')
+                buffer.frombytes(data)
+                yield from buffer
+
+
+class ResultFile:
+
+    def __init__(self, path: str, compress: bool=False):
+        self._files = [open(path, 'wb', buffering=WRITE_BUFFER_SIZE)]
+        if compress:
+            self._files.append(gzip.open(get_compressed_path(path), 'wb', compresslevel=GZIP_LEVEL))
+
+    def write(self, data: bytes):
+        for file in self._files:
+            file.write(data)
+
+    def close(self):
+        for file in self._files:
+            file.close()
 
 
 class DataWriter:
 
-    def __init__(self, work_dir: str):
+    def __init__(self, work_dir: str, formats: Iterable[str]=('json',), compress: bool=False):
         self._work_dir = work_dir
+        self._formats = set(formats)
+        self._compress = compress
 
     def write(self, name: str, numbers: Iterable[int]) -> str:
         path = os.path.join(self._work_dir, name)
         logger.info('Writing sorted numbers into %s', path)
-        with open(path, 'w') as file:
-            file.write('{"state": "ready", "data": [')
+        files = dict((format_name, ResultFile(get_result_path(path, format_name), self._compress))
+                     for format_name in self._formats | {'json'})
+        try:
+            files['json'].write(b'{"state": "ready", "data": [')
             iterator = iter(numbers)
-            file.write(str(next(iterator)))
-            for number in iterator:
-                file.write(', %s' % number)
-            file.write(']}')
+            separator = b''
+            previous = 0
+            while True:
+                with stage('merge'):
+                    batch = to_int_array(islice(iterator, WRITE_BATCH_SIZE))
+                if not batch:
+                    break
+                with stage('write'):
+                    files['json'].write(separator)
+                    files['json'].write(', '.join(map(str, batch)).encode())
+                    separator = b', '
+                    if 'delta' in files:
+                        data, previous = encode_delta_varint(batch, previous)
+                        files['delta'].write(data)
+                    if 'int64' in files:
+                        if sys.byteorder == 'big':
+                            batch.byteswap()
+                        files['int64'].write(batch.tobytes())
+                count('written_numbers', len(batch))
+            files['json'].write(b']}')
+        finally:
+            for file in files.values():
+                file.close()
         return path
@@ -1,58 +1,477 @@
+import asyncio
 import json
+import os
+from functools import partial
 from http import HTTPStatus
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from shutil import copyfileobj
-from typing import Callable, Tuple, Optional, Union, Dict
+from socketserver import ThreadingMixIn
+from typing import Callable, Tuple, Optional, Union, Dict, Iterable, List
 from urllib.parse import parse_qs, urlparse
 
+from .common import logger, RESULT_FORMATS, get_result_path, get_result_format, get_compressed_path, \
+    ServiceUnavailable, StreamInterrupted, STREAM_POLL_INTERVAL
+from .profiler import Profiler
+from .query import JOB_PARAMS
 
-class CustomServer(HTTPServer):
 
-    def __init__(self, *args, on_new_job: Callable, on_get_job_status: Callable, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._on_new_job = on_new_job
-        self._on_get_job_status = on_get_job_status
+MAX_HEADER_COUNT = 100
+METRICS_PATH = '/metrics'
+BATCH_PATH = '/batch'
+MAX_BODY_SIZE = 1024 * 1024
+MAX_WAIT = 60.0
+WAIT_POLL_INTERVAL = 0.1
+RETRY_AFTER = 5
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
 
-    def finish_request(self, request, client_address):
-        self.RequestHandlerClass(request, client_address, self, on_new_job=self._on_new_job,
-                                 on_get_job_status=self._on_get_job_status)
 
+def parse_params(path: str) -> Dict[str, str]:
+    return dict((key, value[0]) for key, value in parse_qs(urlparse(path).query, keep_blank_values=True).items())
 
-class RequestHandler(BaseHTTPRequestHandler):
 
-    def __init__(self, *args, on_new_job: Callable, on_get_job_status: Callable, **kwargs):
+def parse_wait(params: Dict[str, str]) -> float:
+    return min(float(params.get('wait') or 0), MAX_WAIT)
+
+
+def parse_accept(value: str) -> List[Tuple[str, float]]:
+    result = []
+    for item in value.split(','):
+        content_type, *params = item.split(';')
+        quality = 1.0
+        for param in params:
+            name, _, number = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        result.append((content_type.strip().lower(), quality))
+    return result
+
+
+def choose_result_format(params: Dict[str, str], headers: Dict[str, str],
+                         available: Iterable[str]=tuple(RESULT_FORMATS)) -> Optional[str]:
+    if 'format' in params:
+        return params['format'] if params['format'] in RESULT_FORMATS else None
+    best, best_rank = 'json', (0.0, 0)
+    for content_type, quality in parse_accept(headers.get('accept', '*/*')):
+        wildcard = content_type in ('*/*', 'application/*')
+        for format_name in available:
+            rank = quality, 0 if wildcard else 1
+            if quality > 0 and rank > best_rank and (wildcard or content_type == RESULT_FORMATS[format_name][1]):
+                best, best_rank = format_name, rank
+    return best
+
+
+def parse_range(value: str, size: int) -> Optional[Tuple[int, int]]:
+    unit, _, spec = value.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        raise ValueError('unsupported range %s' % value)
+    first, _, last = spec.strip().partition('-')
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            raise ValueError('invalid range %s' % value)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+def get_query(params: Dict[str, object]) -> Dict[str, str]:
+    return dict((name, format_query_value(value)) for name, value in params.items() if name in JOB_PARAMS)
+
+
+def format_query_value(value: object) -> str:
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, list):
+        return ','.join(map(str, value))
+    return str(value)
+
+
+def accepts_encoding(headers: Dict[str, str], encoding: str) -> bool:
+    for item in headers.get('accept-encoding', '').split(','):
+        name, _, params = item.partition(';')
+        if name.strip().lower() not in (encoding, '*'):
+            continue
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def format_server_timing(timings: Dict[str, float]) -> str:
+    return ', '.join('%s;dur=%.3f' % (name, seconds * 1000) for name, seconds in timings.items())
+
+
+def encode_chunk(data: bytes) -> bytes:
+    return b'%x\r\n%s\r\n' % (len(data), data)
+
+
+class Response:
+
+    def __init__(self, status: HTTPStatus, headers: Dict[str, str], body: bytes=b'', path: str=None, offset: int=0,
+                 count: int=0, chunks: Iterable[bytes]=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.path = path
+        self.offset = offset
+        self.count = count
+        self.chunks = chunks
+
+    @classmethod
+    def create(cls, status: HTTPStatus, payload: Optional[Union[dict, str]], request_headers: Dict[str, str]):
+        if isinstance(payload, str):
+            return cls._create_for_file(payload, request_headers)
+        body = b'' if payload is None else json.dumps(payload).encode()
+        return cls(status, {'Content-Type': 'application/json', 'Content-Length': str(len(body))}, body)
+
+    @classmethod
+    def _create_for_file(cls, path: str, request_headers: Dict[str, str]):
+        content_type = RESULT_FORMATS[get_result_format(path) or 'json'][1]
+        headers = {'Content-Type': content_type, 'Accept-Ranges': 'bytes'}
+        compressed_path = get_compressed_path(path)
+        encoding = ''
+        if os.path.exists(compressed_path) and os.path.getsize(compressed_path) < os.path.getsize(path):
+            headers['Vary'] = 'Accept-Encoding'
+            if accepts_encoding(request_headers, 'gzip'):
+                path = compressed_path
+                encoding = 'gzip'
+                headers['Content-Encoding'] = encoding
+        stat = os.stat(path)
+        size = stat.st_size
+        etag = '"%x-%x%s"' % (stat.st_mtime_ns, size, encoding and '-' + encoding)
+        headers['ETag'] = etag
+        if_none_match = request_headers.get('if-none-match')
+        if if_none_match and (if_none_match.strip() == '*' or etag in map(str.strip, if_none_match.split(','))):
+            headers['Content-Length'] = '0'
+            return cls(HTTPStatus.NOT_MODIFIED, headers)
+        value = request_headers.get('range')
+        if value and request_headers.get('if-range', etag) == etag:
+            try:
+                byte_range = parse_range(value, size)
+            except ValueError:
+                byte_range = 0, size - 1
+            if byte_range is None:
+                headers.update({'Content-Range': 'bytes */%s' % size, 'Content-Length': '0'})
+                return cls(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, headers)
+            start, end = byte_range
+            if (start, end) != (0, size - 1):
+                headers.update({'Content-Range': 'bytes %s-%s/%s' % (start, end, size),
+                                'Content-Length': str(end - start + 1)})
+                return cls(HTTPStatus.PARTIAL_CONTENT, headers, path=path, offset=start, count=end - start + 1)
+        headers['Content-Length'] = str(size)
+        return cls(HTTPStatus.OK, headers, path=path, count=size)
+
+
+class JobApi:
+
+    def __init__(self, on_new_job: Callable, on_get_job_status: Callable, on_get_stats: Callable=None,
+                 on_get_partition: Callable=None, on_get_metrics: Callable=None, on_stream_result: Callable=None,
+                 profiler: Profiler=None, on_new_jobs: Callable=None, on_watch_job: Callable=None):
         self._on_new_job = on_new_job
+        self._on_new_jobs = on_new_jobs
         self._on_get_job_status = on_get_job_status
-        super().__init__(*args, **kwargs)
+        self._on_get_stats = on_get_stats
+        self._on_get_partition = on_get_partition
+        self._on_get_metrics = on_get_metrics
+        self._on_stream_result = on_stream_result
+        self._on_watch_job = on_watch_job
+        self._profiler = profiler or Profiler()
 
-    def do_GET(self):
-        params = self._parse_params(self.path)
-        status, payload = self._handle_request(params)
-        self._send_response(status, payload)
+    def handle(self, path: str, headers: Dict[str, str], client: str=None, blocking: bool=True) -> Response:
+        with self._profiler.profile():
+            return self._handle(path, headers, client, blocking)
+
+    def handle_post(self, path: str, headers: Dict[str, str], body: bytes, client: str=None) -> Response:
+        with self._profiler.profile():
+            return self._handle_post(path, headers, body, client)
+
+    def get_waited_job(self, path: str) -> Optional[Tuple[str, float]]:
+        params = parse_params(path)
+        try:
+            wait = parse_wait(params)
+        except ValueError:
+            return None
+        return (params['get'], wait) if 'get' in params and wait > 0 else None
+
+    def is_job_settled(self, job_id: str) -> bool:
+        status = self._on_get_job_status(job_id)
+        return not status or status.is_final()
+
+    def watch_job(self, job_id: str, callback: Callable[[], None]) -> Optional[Callable[[], None]]:
+        return self._on_watch_job and self._on_watch_job(job_id, callback)
 
-    def _parse_params(self, path):
-        return dict((key, value[0]) for key, value in parse_qs(urlparse(path).query).items())
+    def _handle(self, path: str, headers: Dict[str, str], client: str=None, blocking: bool=True) -> Response:
+        if urlparse(path).path == METRICS_PATH and self._on_get_metrics:
+            body = self._on_get_metrics().encode()
+            return Response(HTTPStatus.OK, {'Content-Type': METRICS_CONTENT_TYPE, 'Content-Length': str(len(body))},
+                            body)
+        params = parse_params(path)
+        if 'get' in params:
+            return self._get_job(params, headers, blocking)
+        try:
+            status, payload = self._handle_params(params, client)
+        except ServiceUnavailable as e:
+            return self._create_unavailable(str(e), headers)
+        return Response.create(status, payload, headers)
+
+    def _handle_post(self, path: str, headers: Dict[str, str], body: bytes, client: str=None) -> Response:
+        if urlparse(path).path != BATCH_PATH:
+            return Response.create(HTTPStatus.NOT_FOUND, None, headers)
+        try:
+            items = json.loads(body)
+            if isinstance(items, dict):
+                items = items['jobs']
+            jobs = [(str(item['concurrency']), str(item['url']), str(item.get('priority', 'normal')), get_query(item))
+                    for item in items]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return Response.create(HTTPStatus.BAD_REQUEST, dict(state='error', data='invalid batch'), headers)
+        try:
+            if self._on_new_jobs:
+                job_ids = self._on_new_jobs(jobs, client)
+            else:
+                job_ids = [self._on_new_job(concurrency, url, priority, client, query)
+                           for concurrency, url, priority, query in jobs]
+        except ServiceUnavailable as e:
+            return self._create_unavailable(str(e), headers)
+        return Response.create(HTTPStatus.OK, dict(jobids=job_ids), headers)
 
-    def _handle_request(self, params: Dict[str, str]) -> Tuple[HTTPStatus, Optional[Union[dict, str]]]:
+    def _create_unavailable(self, message: str, headers: Dict[str, str]) -> Response:
+        response = Response.create(HTTPStatus.SERVICE_UNAVAILABLE, dict(state='error', data=message), headers)
+        response.headers['Retry-After'] = str(RETRY_AFTER)
+        return response
+
+    def _handle_params(self, params: Dict[str, str], client: str=None) -> Tuple[HTTPStatus, Optional[Union[dict, str]]]:
         if 'concurrency' in params and 'sort' in params:
-            job_id = self._on_new_job(params['concurrency'], params['sort'])
+            job_id = self._on_new_job(params['concurrency'], params['sort'], params.get('priority', 'normal'), client,
+                                      get_query(params))
             return HTTPStatus.OK, dict(jobid=job_id)
-        if 'get' in params:
-            status = self._on_get_job_status(params['get'])
-            if not status:
+        if 'stats' in params and self._on_get_stats:
+            return HTTPStatus.OK, self._on_get_stats()
+        if 'partition' in params and self._on_get_partition:
+            path = self._on_get_partition(params['partition'])
+            if not path:
                 return HTTPStatus.NOT_FOUND, dict(state='eexist', data=None)
-            if status.has_file_path():
-                return HTTPStatus.OK, status.data
-            return HTTPStatus.OK, dict(state=status.state, data=status.data)
+            return HTTPStatus.OK, path
         return HTTPStatus.BAD_REQUEST, None
 
-    def _send_response(self, status: HTTPStatus, payload: Union[dict, str]=None):
-        self.send_response(status.value)
-        self.send_header('Content-Type', 'application/json')
+    def _get_job(self, params: Dict[str, str], headers: Dict[str, str], blocking: bool=True) -> Response:
+        try:
+            wait = parse_wait(params)
+        except ValueError:
+            return Response.create(HTTPStatus.BAD_REQUEST, dict(state='error', data='wait must be a number'), headers)
+        if blocking and wait > 0:
+            status = self._on_get_job_status(params['get'], wait)
+        else:
+            status = self._on_get_job_status(params['get'])
+        if not status:
+            return Response.create(HTTPStatus.NOT_FOUND, dict(state='eexist', data=None), headers)
+        if (params.get('stream') == '1' and not status.is_final() and self._on_stream_result
+                and choose_result_format(params, headers, ('json',)) == 'json'):
+            chunks = self._on_stream_result(params['get'], blocking)
+            if chunks is not None:
+                return Response(HTTPStatus.OK, {'Content-Type': RESULT_FORMATS['json'][1],
+                                                'Transfer-Encoding': 'chunked'}, chunks=chunks)
+        if status.has_file_path():
+            available = [name for name in RESULT_FORMATS if os.path.exists(get_result_path(status.data, name))]
+            format_name = choose_result_format(params, headers, available)
+            path = format_name and get_result_path(status.data, format_name)
+            if not path or not os.path.exists(path):
+                return Response.create(HTTPStatus.NOT_ACCEPTABLE, dict(state='error', data='format is not available'),
+                                       headers)
+            response = Response.create(HTTPStatus.OK, path, headers)
+            if status.timings:
+                response.headers['Server-Timing'] = format_server_timing(status.timings['durations'])
+            return response
+        payload = dict(state=status.state, data=status.data)
+        if status.timings:
+            payload['timings'] = status.timings
+        if status.completion:
+            payload['progress'] = status.completion
+        return Response.create(HTTPStatus.OK, payload, headers)
+
+
+class CustomServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, *args, api: JobApi, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._api = api
+
+    def finish_request(self, request, client_address):
+        self.RequestHandlerClass(request, client_address, self, api=self._api)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, *args, api: JobApi, **kwargs):
+        self._api = api
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        headers = dict((key.lower(), value) for key, value in self.headers.items())
+        self._send_response(self._api.handle(self.path, headers, self.client_address[0]))
+
+    def do_POST(self):
+        headers = dict((key.lower(), value) for key, value in self.headers.items())
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            length = -1
+        if not 0 <= length <= MAX_BODY_SIZE:
+            self.close_connection = True
+            self._send_response(Response.create(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, None, headers))
+            return
+        body = self.rfile.read(length)
+        self._send_response(self._api.handle_post(self.path, headers, body, self.client_address[0]))
+
+    def _send_response(self, response: Response):
+        self.send_response(response.status.value)
+        for key, value in response.headers.items():
+            self.send_header(key, value)
         self.end_headers()
-        if payload is not None:
-            if isinstance(payload, str):
-                with open(payload, 'rb') as file:
-                    copyfileobj(file, self.wfile)
-            else:
-                self.wfile.write(json.dumps(payload).encode())
+        if response.path:
+            if response.count:
+                with open(response.path, 'rb') as file:
+                    self.connection.sendfile(file, response.offset, response.count)
+        elif response.chunks is not None:
+            try:
+                for chunk in response.chunks:
+                    self.wfile.write(encode_chunk(chunk))
+            except StreamInterrupted as e:
+                logger.debug('Closing connection on interrupted stream: %s', e)
+                self.close_connection = True
+                return
+            self.wfile.write(encode_chunk(b''))
+        else:
+            self.wfile.write(response.body)
+
+
+class AsyncServer:
+
+    def __init__(self, address: Tuple[str, int], api: JobApi):
+        self._address = address
+        self._api = api
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopped: Optional[asyncio.Event] = None
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    async def _serve(self):
+        host, port = self._address
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        server = await asyncio.start_server(self._handle_connection, host or None, port)
+        logger.info('Asyncio server is listening on %s', self._address)
+        async with server:
+            await self._stopped.wait()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client = (writer.get_extra_info('peername') or ('',))[0]
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, keep_alive = request
+                if method == 'GET':
+                    waited = self._api.get_waited_job(path)
+                    if waited:
+                        await self._wait_for_job(*waited)
+                    response = self._api.handle(path, headers, client, blocking=False)
+                elif method == 'POST':
+                    length = int(headers.get('content-length') or 0)
+                    if not 0 <= length <= MAX_BODY_SIZE:
+                        await self._send_response(
+                            writer, Response.create(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, None, headers))
+                        break
+                    body = await reader.readexactly(length)
+                    response = self._api.handle_post(path, headers, body, client)
+                else:
+                    response = Response.create(HTTPStatus.NOT_IMPLEMENTED, None, headers)
+                await self._send_response(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except StreamInterrupted as e:
+            logger.debug('Closing connection on interrupted stream: %s', e)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            logger.debug('Closing connection on error: %s', e)
+        finally:
+            writer.close()
+
+    async def _wait_for_job(self, job_id: str, timeout: float):
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        unwatch = self._api.watch_job(job_id, partial(loop.call_soon_threadsafe, changed.set))
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                changed.clear()
+                remaining = deadline - loop.time()
+                if remaining <= 0 or self._api.is_job_settled(job_id):
+                    break
+                try:
+                    await asyncio.wait_for(changed.wait(), remaining if unwatch else min(remaining, WAIT_POLL_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if unwatch:
+                unwatch()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bool]]:
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        method, path, version = line.decode('latin-1').split()
+        headers = {}
+        for _ in range(MAX_HEADER_COUNT):
+            line = await reader.readline()
+            if not line.strip():
+                break
+            key, value = line.decode('latin-1').split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        else:
+            raise ValueError('too many headers')
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+        return method, path, headers, keep_alive
+
+    async def _send_response(self, writer: asyncio.StreamWriter, response: Response, keep_alive: bool=False):
+        writer.write(('HTTP/1.1 %s %s\r\n' % (response.status.value, response.status.phrase)).encode())
+        for key, value in response.headers.items():
+            writer.write(('%s: %s\r\n' % (key, value)).encode())
+        writer.write(b'Connection: keep-alive\r\n\r\n' if keep_alive else b'Connection: close\r\n\r\n')
+        if response.path:
+            await writer.drain()
+            if response.count:
+                with open(response.path, 'rb') as file:
+                    await asyncio.get_running_loop().sendfile(writer.transport, file, response.offset, response.count)
+        elif response.chunks is not None:
+            for chunk in response.chunks:
+                if chunk:
+                    writer.write(encode_chunk(chunk))
+                    await writer.drain()
+                else:
+                    await asyncio.sleep(STREAM_POLL_INTERVAL)
+            writer.write(encode_chunk(b''))
+        else:
+            writer.write(response.body)
+        await writer.drain()
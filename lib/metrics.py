@@ -0,0 +1,181 @@
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock, local
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+
+STAGES = ('queue', 'download', 'parse', 'select', 'sort', 'merge', 'write')
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+METRIC_PREFIX = 'sorter'
+PROGRESS_COUNTS = ('download_bytes', 'sorted_numbers', 'written_numbers')
+
+_current = local()
+
+
+class JobTimings:
+
+    def __init__(self):
+        self.durations: Dict[str, float] = defaultdict(float)
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.expected: Dict[str, int] = {}
+        self._lock = Lock()
+        self._stack: List[str] = []
+        self._started_at = 0.0
+        self._created_at = perf_counter()
+
+    def add(self, name: str, seconds: float):
+        self.durations[name] += seconds
+
+    def count(self, name: str, value: int):
+        with self._lock:
+            self.counts[name] += value
+
+    def expect(self, name: str, value: int):
+        self.expected[name] = value
+
+    def enter(self, name: str):
+        now = perf_counter()
+        if self._stack:
+            self.durations[self._stack[-1]] += now - self._started_at
+        self._stack.append(name)
+        self._started_at = now
+
+    def leave(self):
+        now = perf_counter()
+        self.durations[self._stack.pop()] += now - self._started_at
+        self._started_at = now
+
+    def get_total(self) -> float:
+        return perf_counter() - self._created_at + self.durations.get('queue', 0.0)
+
+    def get_progress(self) -> dict:
+        result = dict((name, self.counts.get(name, 0)) for name in PROGRESS_COUNTS)
+        done = 0.0
+        fraction = 0.0
+        for name in reversed(PROGRESS_COUNTS):
+            expected = self.expected.get(name)
+            if expected:
+                done = max(done, min(self.counts.get(name, 0) / expected, 1.0))
+            fraction += done
+        result['fraction'] = round(fraction / len(PROGRESS_COUNTS), 4)
+        return result
+
+    def to_dict(self) -> dict:
+        durations = dict((name, round(seconds, 6)) for name, seconds in self.durations.items())
+        durations['total'] = round(self.get_total(), 6)
+        return dict(durations=durations, counts=dict(self.counts))
+
+
+def get_job_timings() -> Optional[JobTimings]:
+    return getattr(_current, 'timings', None)
+
+
+@contextmanager
+def track_job(timings: JobTimings):
+    _current.timings = timings
+    try:
+        yield timings
+    finally:
+        _current.timings = None
+
+
+@contextmanager
+def stage(name: str):
+    timings = get_job_timings()
+    if timings is None:
+        yield
+        return
+    timings.enter(name)
+    try:
+        yield
+    finally:
+        timings.leave()
+
+
+def count(name: str, value: int):
+    timings = get_job_timings()
+    if timings is not None:
+        timings.count(name, value)
+
+
+def expect(name: str, value: int):
+    timings = get_job_timings()
+    if timings is not None:
+        timings.expect(name, value)
+
+
+class Histogram:
+
+    def __init__(self, buckets: Tuple[float, ...]=LATENCY_BUCKETS):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        self._counts[bisect_left(self._buckets, value)] += 1
+        self._sum += value
+
+    def render(self, name: str, labels: str='') -> List[str]:
+        prefix = labels + ',' if labels else ''
+        suffix = '{%s}' % labels if labels else ''
+        lines = []
+        total = 0
+        for bound, bucket_count in zip(self._buckets + (float('Inf'),), self._counts):
+            total += bucket_count
+            lines.append('%s_bucket{%sle="%s"} %s' % (name, prefix, '+Inf' if bound == float('Inf') else bound, total))
+        lines.append('%s_sum%s %s' % (name, suffix, self._sum))
+        lines.append('%s_count%s %s' % (name, suffix, total))
+        return lines
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = Lock()
+        self._stages: Dict[str, Histogram] = dict((name, Histogram()) for name in STAGES)
+        self._jobs = Histogram()
+        self._states: Dict[str, int] = defaultdict(int)
+        self._counters: Dict[str, int] = defaultdict(int)
+
+    def observe_job(self, timings: JobTimings, state: str):
+        with self._lock:
+            for name, seconds in timings.durations.items():
+                self._stages.setdefault(name, Histogram()).observe(seconds)
+            self._jobs.observe(timings.get_total())
+            self._states[state] += 1
+            for name, value in timings.counts.items():
+                self._counters[name] += value
+
+    def render(self, stats: dict=None) -> str:
+        lines = []
+        with self._lock:
+            name = '%s_stage_seconds' % METRIC_PREFIX
+            lines.append('# TYPE %s histogram' % name)
+            for stage_name, histogram in self._stages.items():
+                lines.extend(histogram.render(name, 'stage="%s"' % stage_name))
+            name = '%s_job_seconds' % METRIC_PREFIX
+            lines.append('# TYPE %s histogram' % name)
+            lines.extend(self._jobs.render(name))
+            name = '%s_jobs_total' % METRIC_PREFIX
+            lines.append('# TYPE %s counter' % name)
+            lines.extend('%s{state="%s"} %s' % (name, state, value) for state, value in sorted(self._states.items()))
+            for counter_name, value in sorted(self._counters.items()):
+                name = '%s_%s_total' % (METRIC_PREFIX, counter_name)
+                lines.append('# TYPE %s counter' % name)
+                lines.append('%s %s' % (name, value))
+        for gauge_name, value in sorted(self._flatten(stats or {}, METRIC_PREFIX).items()):
+            lines.append('# TYPE %s gauge' % gauge_name)
+            lines.append('%s %s' % (gauge_name, value))
+        return '\n'.join(lines) + '\n'
+
+    def _flatten(self, stats: dict, prefix: str) -> Dict[str, float]:
+        result = {}
+        for key, value in stats.items():
+            name = '%s_%s' % (prefix, key)
+            if isinstance(value, dict):
+                result.update(self._flatten(value, name))
+            elif isinstance(value, (int, float)):
+                result[name] = value
+        return result
@@ -0,0 +1,116 @@
+import cProfile
+import os
+import pstats
+import sys
+from collections import Counter
+from contextlib import contextmanager
+from threading import Event, Lock, Thread, get_ident
+from typing import Iterator, List, Optional
+
+from .common import logger
+
+
+PROFILERS = ('cprofile', 'sampling')
+SAMPLING_INTERVAL = 0.005
+
+
+class Profiler:
+
+    def start(self):
+        pass
+
+    @contextmanager
+    def profile(self) -> Iterator[None]:
+        yield
+
+    def stop(self):
+        pass
+
+
+class CallProfiler(Profiler):
+
+    def __init__(self, path: str):
+        self._path = path
+        self._stats: Optional[pstats.Stats] = None
+        self._lock = Lock()
+
+    @contextmanager
+    def profile(self) -> Iterator[None]:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            profile = None
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+                self._add(profile)
+
+    def stop(self):
+        with self._lock:
+            if self._stats:
+                self._stats.dump_stats(self._path)
+                logger.info('Profile is saved to %s', self._path)
+
+    def _add(self, profile: cProfile.Profile):
+        with self._lock:
+            if self._stats:
+                self._stats.add(profile)
+            else:
+                self._stats = pstats.Stats(profile)
+
+
+class SamplingProfiler(Profiler):
+
+    def __init__(self, path: str, interval: float=SAMPLING_INTERVAL):
+        self._path = path
+        self._interval = interval
+        self._samples: Counter = Counter()
+        self._active: Counter = Counter()
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    @contextmanager
+    def profile(self) -> Iterator[None]:
+        ident = get_ident()
+        with self._lock:
+            self._active[ident] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= Counter({ident: 1})
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        with open(self._path, 'w') as file:
+            for stack, count in self._samples.most_common():
+                file.write('%s %s\n' % (stack, count))
+        logger.info('Profile is saved to %s', self._path)
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            frames = sys._current_frames()
+            with self._lock:
+                idents = list(self._active)
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame:
+                    self._samples[';'.join(get_stack(frame))] += 1
+
+
+def get_stack(frame) -> List[str]:
+    stack = []
+    while frame:
+        code = frame.f_code
+        stack.append('%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return stack[::-1]
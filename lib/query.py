@@ -0,0 +1,161 @@
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_right
+from heapq import nsmallest, nlargest
+from itertools import chain
+from math import ceil
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from .common import CustomException, unique_sorted
+from .data import DataSorter, ExternalSorter
+from .metrics import stage
+
+
+QUERY_PARAMS = ('top', 'range', 'quantiles')
+JOB_PARAMS = QUERY_PARAMS + ('unique',)
+MAX_TOP_COUNT = 1000000
+MAX_QUANTILE_COUNT = 100
+
+
+class Query(ABC):
+
+    @abstractmethod
+    def select(self, name: str, chunks: Iterable[Sequence[int]], sorter: DataSorter, unique: bool=False,
+               external_sorter: ExternalSorter=None) -> Iterable[int]:
+        pass
+
+
+class TopQuery(Query):
+
+    def __init__(self, count: int):
+        self.count = count
+
+    def select(self, name: str, chunks: Iterable[Sequence[int]], sorter: DataSorter, unique: bool=False,
+               external_sorter: ExternalSorter=None) -> Iterable[int]:
+        size = abs(self.count)
+        best: List[int] = []
+        for numbers in chunks:
+            with stage('select'):
+                candidates = set(chain(best, numbers)) if unique else chain(best, numbers)
+                best = nsmallest(size, candidates) if self.count > 0 else nlargest(size, candidates)
+        return best if self.count > 0 else best[::-1]
+
+    def __str__(self):
+        return 'top=%s' % self.count
+
+
+class RangeQuery(Query):
+
+    def __init__(self, low: Optional[int], high: Optional[int]):
+        self.low = low
+        self.high = high
+
+    def select(self, name: str, chunks: Iterable[Sequence[int]], sorter: DataSorter, unique: bool=False,
+               external_sorter: ExternalSorter=None) -> Iterable[int]:
+        if external_sorter:
+            numbers = external_sorter.sort(name, self._filter(chunks), sorter)
+        else:
+            numbers = sorter.sort_all(self._filter(chunks))
+        return unique_sorted(numbers) if unique else numbers
+
+    def _filter(self, chunks: Iterable[Sequence[int]]) -> Iterable[array]:
+        low = float('-Inf') if self.low is None else self.low
+        high = float('Inf') if self.high is None else self.high
+        for numbers in chunks:
+            with stage('select'):
+                selected = array('q', [number for number in numbers if low <= number <= high])
+            if selected:
+                yield selected
+
+    def __str__(self):
+        return 'range=%s:%s' % ('' if self.low is None else self.low, '' if self.high is None else self.high)
+
+
+class QuantilesQuery(Query):
+
+    def __init__(self, fractions: List[float]):
+        self.fractions = fractions
+
+    def select(self, name: str, chunks: Iterable[Sequence[int]], sorter: DataSorter, unique: bool=False,
+               external_sorter: ExternalSorter=None) -> Iterable[int]:
+        if external_sorter:
+            with external_sorter.open_runs(name, chunks, sorter) as runs:
+                return self._select(runs)
+        return self._select([run for run in sorter.sort_runs(chunks) if len(run)])
+
+    def _select(self, runs: List[Sequence[int]]) -> List[int]:
+        total = sum(map(len, runs))
+        if not total:
+            raise CustomException('data seems empty')
+        with stage('select'):
+            return [select_rank(runs, max(int(ceil(fraction * total)), 1)) for fraction in self.fractions]
+
+    def __str__(self):
+        return 'quantiles=%s' % ','.join(map(str, self.fractions))
+
+
+def select_rank(runs: List[Sequence[int]], rank: int) -> int:
+    low = min(run[0] for run in runs)
+    high = max(run[-1] for run in runs)
+    while low < high:
+        middle = (low + high) // 2
+        if sum(bisect_right(run, middle) for run in runs) >= rank:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def parse_query(params: Dict[str, str]) -> Optional[Query]:
+    names = [name for name in QUERY_PARAMS if name in params]
+    if not names:
+        return None
+    if len(names) > 1:
+        raise CustomException('only one of %s is allowed' % ', '.join(QUERY_PARAMS))
+    name = names[0]
+    value = params[name]
+    if name == 'top':
+        return TopQuery(_parse_top(value))
+    if name == 'range':
+        return RangeQuery(*_parse_range(value))
+    return QuantilesQuery(_parse_quantiles(value))
+
+
+def parse_unique(params: Dict[str, str]) -> bool:
+    value = params.get('unique', '0')
+    if value not in ('0', '1'):
+        raise CustomException('unique must be 0 or 1')
+    return value == '1'
+
+
+def _parse_top(value: str) -> int:
+    try:
+        count = int(value)
+    except ValueError:
+        raise CustomException('top must be integer')
+    if not count or abs(count) > MAX_TOP_COUNT:
+        raise CustomException('top must be non-zero and not greater than %s by magnitude' % MAX_TOP_COUNT)
+    return count
+
+
+def _parse_range(value: str) -> List[Optional[int]]:
+    low, separator, high = value.partition(':')
+    try:
+        bounds = [int(bound) if bound.strip() else None for bound in (low, high)]
+    except ValueError:
+        bounds = None
+    if not separator or bounds is None:
+        raise CustomException('range must look like a:b')
+    if None not in bounds and bounds[0] > bounds[1]:
+        raise CustomException('range start must not be greater than its end')
+    return bounds
+
+
+def _parse_quantiles(value: str) -> List[float]:
+    try:
+        fractions = [float(item) for item in value.split(',')]
+    except ValueError:
+        raise CustomException('quantiles must be numbers')
+    if not 0 < len(fractions) <= MAX_QUANTILE_COUNT or not all(0 <= fraction <= 1 for fraction in fractions):
+        raise CustomException('quantiles must be up to %s numbers between 0 and 1' % MAX_QUANTILE_COUNT)
+    return fractions
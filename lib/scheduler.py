@@ -0,0 +1,135 @@
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappush, heappop
+from itertools import count
+from threading import Condition
+from typing import Optional, Dict, List, Tuple
+
+from .common import Job, logger
+from .data import Downloader, get_content_length
+
+
+PRIORITIES = OrderedDict((('high', 0), ('normal', 1), ('low', 2)))
+DEFAULT_PRIORITY = 'normal'
+LANE_SMALL = 'small'
+LANE_LARGE = 'large'
+LANE_ESTIMATING = 'estimating'
+SMALL_LANE_WEIGHT = 3
+ESTIMATOR_COUNT = 8
+
+
+class JobLane:
+
+    def __init__(self):
+        self._clients: Dict[str, List[Tuple[int, int, int, Job]]] = {}
+        self._order = deque()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def put(self, job: Job, size: int, sequence: int):
+        if job.client not in self._clients:
+            self._clients[job.client] = []
+            self._order.append(job.client)
+        heappush(self._clients[job.client], (PRIORITIES.get(job.priority, PRIORITIES[DEFAULT_PRIORITY]), size,
+                                             sequence, job))
+        self._size += 1
+
+    def get(self) -> Job:
+        client = self._order.popleft()
+        jobs = self._clients[client]
+        job = heappop(jobs)[3]
+        if jobs:
+            self._order.append(client)
+        else:
+            del self._clients[client]
+        self._size -= 1
+        return job
+
+
+class JobScheduler:
+
+    def __init__(self, downloader: Downloader, small_job_size: int, estimator_count: int=ESTIMATOR_COUNT):
+        self._downloader = downloader
+        self._small_job_size = small_job_size
+        self._estimators = ThreadPoolExecutor(estimator_count)
+        self._lanes = {LANE_SMALL: JobLane(), LANE_LARGE: JobLane()}
+        self._estimating = 0
+        self._small_picks = 0
+        self._stops = 0
+        self._idle = 0
+        self._draining = False
+        self._sequence = count()
+        self._condition = Condition()
+
+    def put(self, job: Optional[Job]):
+        with self._condition:
+            if job is None:
+                self._stops += 1
+                self._condition.notify()
+                return
+            if self._idle and not self._estimating and not any(self._lanes.values()):
+                self._lanes[LANE_SMALL].put(job, self._small_job_size, next(self._sequence))
+                self._condition.notify()
+                return
+            self._estimating += 1
+        self._estimators.submit(self._estimate, job)
+
+    def get(self) -> Optional[Job]:
+        with self._condition:
+            while True:
+                if self._draining:
+                    return None
+                lane = self._choose_lane()
+                if lane:
+                    return lane.get()
+                if self._stops and not self._estimating:
+                    self._stops -= 1
+                    return None
+                self._idle += 1
+                self._condition.wait()
+                self._idle -= 1
+
+    def get_depths(self) -> Dict[str, int]:
+        with self._condition:
+            depths = dict((name, len(lane)) for name, lane in self._lanes.items())
+            depths[LANE_ESTIMATING] = self._estimating
+            return depths
+
+    def stop(self):
+        self._estimators.shutdown(wait=False)
+
+    def drain(self) -> List[Job]:
+        with self._condition:
+            self._draining = True
+            jobs = []
+            for lane in self._lanes.values():
+                while lane:
+                    jobs.append(lane.get())
+            self._condition.notify_all()
+            return jobs
+
+    def _estimate(self, job: Job):
+        size = None
+        try:
+            job.headers = self._downloader.head(job.url)
+            size = get_content_length(job.headers)
+        except Exception as e:
+            logger.debug('Cannot estimate size of %s: %s', job, e)
+        lane = LANE_LARGE if size is not None and size > self._small_job_size else LANE_SMALL
+        logger.debug('Job %s has size %s, scheduling into %s lane', job, size, lane)
+        with self._condition:
+            self._estimating -= 1
+            self._lanes[lane].put(job, self._small_job_size if size is None else size, next(self._sequence))
+            self._condition.notify()
+
+    def _choose_lane(self) -> Optional[JobLane]:
+        small, large = self._lanes[LANE_SMALL], self._lanes[LANE_LARGE]
+        if small and (not large or self._small_picks < SMALL_LANE_WEIGHT):
+            self._small_picks += 1
+            return small
+        if large:
+            self._small_picks = 0
+            return large
+        return None
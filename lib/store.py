@@ -0,0 +1,118 @@
+import sqlite3
+from collections import OrderedDict, defaultdict
+from functools import partial
+from threading import Lock, Condition
+from time import time, monotonic
+from typing import Optional, Dict, Callable, Tuple, List
+
+from .common import logger, JobStatus
+
+
+EXPIRE_INTERVAL = 1.0
+
+
+class JobStore:
+
+    def __init__(self, ttl: float, index_path: str=None, on_expire: Callable[[str, JobStatus], None]=None):
+        self._ttl = ttl
+        self._on_expire = on_expire
+        self._statuses: Dict[str, Tuple[JobStatus, float]] = OrderedDict()
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._watchers: Dict[str, List[Callable[[], None]]] = defaultdict(list)
+        self._expired_at = 0.0
+        self._index = None
+        if index_path:
+            logger.info('Using job index %s', index_path)
+            self._index = sqlite3.connect(index_path, check_same_thread=False, isolation_level=None)
+            self._index.execute('CREATE TABLE IF NOT EXISTS jobs '
+                                '(id TEXT PRIMARY KEY, state TEXT NOT NULL, data TEXT, updated REAL NOT NULL)')
+            self._index.execute('CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated)')
+
+    def close(self):
+        if self._index:
+            with self._lock:
+                self._index.close()
+                self._index = None
+
+    def __len__(self) -> int:
+        return len(self._statuses)
+
+    def __getitem__(self, job_id: str) -> JobStatus:
+        status = self.get(job_id)
+        if status is None:
+            raise KeyError(job_id)
+        return status
+
+    def __setitem__(self, job_id: str, status: JobStatus):
+        now = time()
+        with self._lock:
+            self._statuses.pop(job_id, None)
+            self._statuses[job_id] = status, now
+            if self._index and status.is_final():
+                self._index.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)',
+                                    (job_id, status.state, status.data, now))
+            self._changed.notify_all()
+            watchers = list(self._watchers.get(job_id, ()))
+        for callback in watchers:
+            callback()
+        self._expire(now)
+
+    def wait(self, job_id: str, timeout: float) -> Optional[JobStatus]:
+        deadline = monotonic() + timeout
+        with self._changed:
+            while True:
+                item = self._statuses.get(job_id)
+                remaining = deadline - monotonic()
+                if not item or item[0].is_final() or remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+        return self.get(job_id)
+
+    def watch(self, job_id: str, callback: Callable[[], None]) -> Callable[[], None]:
+        with self._lock:
+            self._watchers[job_id].append(callback)
+        return partial(self._unwatch, job_id, callback)
+
+    def _unwatch(self, job_id: str, callback: Callable[[], None]):
+        with self._lock:
+            watchers = self._watchers.get(job_id)
+            if watchers and callback in watchers:
+                watchers.remove(callback)
+                if not watchers:
+                    del self._watchers[job_id]
+
+    def get(self, job_id: str) -> Optional[JobStatus]:
+        self._expire(time())
+        with self._lock:
+            item = self._statuses.get(job_id)
+            if item:
+                return item[0]
+            if self._index:
+                row = self._index.execute('SELECT state, data FROM jobs WHERE id = ?', (job_id,)).fetchone()
+                if row:
+                    return JobStatus(*row)
+        return None
+
+    def _expire(self, now: float):
+        if now - self._expired_at < EXPIRE_INTERVAL:
+            return
+        deadline = now - self._ttl
+        expired = []
+        with self._lock:
+            self._expired_at = now
+            for job_id, (status, updated) in list(self._statuses.items()):
+                if updated >= deadline:
+                    break
+                if status.is_final():
+                    del self._statuses[job_id]
+                    expired.append((job_id, status))
+            if self._index:
+                rows = self._index.execute('SELECT id, state, data FROM jobs WHERE updated < ?', (deadline,)).fetchall()
+                self._index.execute('DELETE FROM jobs WHERE updated < ?', (deadline,))
+                expired.extend((job_id, JobStatus(state, data)) for job_id, state, data in rows)
+        if expired:
+            logger.debug('Expiring %s jobs', len(expired))
+        if self._on_expire:
+            for job_id, status in expired:
+                self._on_expire(job_id, status)
@@ -1,40 +1,147 @@
 #!/usr/bin/env python3
 
-from argparse import ArgumentParser
+import os
+import signal
+from argparse import ArgumentParser, Namespace, ArgumentTypeError
+from contextlib import nullcontext
 from tempfile import TemporaryDirectory
-from typing import Tuple
+from threading import Thread
+from typing import List
 
-from lib.background import BackgroundMaster, JobValidator
-from lib.common import logger
-from lib.data import DataDownloader, DataReader, DataWriter
-from lib.http import CustomServer, RequestHandler
+from lib.background import BackgroundMaster, JobValidator, JobProcessor, JobCoalescer
+from lib.cache import ResultCache
+from lib.cluster import ClusterSorter
+from lib.scheduler import JobScheduler
+from lib.store import JobStore
+from lib.common import logger, SORT_KERNELS, RESULT_FORMATS
+from lib.data import DataDownloader, DataReader, DataWriter, ThreadSortBackend, ProcessSortBackend, SortBackend, \
+    ExternalSorter, DataSorterFactory, RangeDataDownloader, DataPipeline
+from lib.http import CustomServer, RequestHandler, AsyncServer, JobApi
+from lib.metrics import Metrics
+from lib.profiler import PROFILERS, Profiler, CallProfiler, SamplingProfiler
 
 
-LISTEN_ADDRESS = ('', 8888)
+LISTEN_HOST = ''
+DEFAULT_PORT = 8888
+QUEUE_FILE_NAME = 'queue.json'
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
 
 
-def parse_args() -> Tuple[int, int]:
+def parse_size(value: str) -> int:
+    multiplier = SIZE_SUFFIXES.get(value[-1:].upper())
+    if multiplier:
+        return int(value[:-1]) * multiplier
+    return int(value)
+
+
+def parse_formats(value: str) -> List[str]:
+    formats = [item.strip() for item in value.split(',')]
+    unknown = set(formats) - set(RESULT_FORMATS)
+    if unknown:
+        raise ArgumentTypeError('unknown formats: %s' % ', '.join(sorted(unknown)))
+    return list({'json'} | set(formats))
+
+
+def parse_peers(value: str) -> List[str]:
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def parse_args() -> Namespace:
     parser = ArgumentParser()
     parser.add_argument('--workers', required=True, type=int)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
     parser.add_argument('--max-concurrency', type=int, default=50)
-    args = parser.parse_args()
-    return args.workers, args.max_concurrency
+    parser.add_argument('--sort-backend', choices=('threads', 'processes'), default='threads')
+    parser.add_argument('--sort-budget', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--sort-kernel', choices=('auto',) + tuple(SORT_KERNELS), default='auto')
+    parser.add_argument('--max-sort-memory', type=parse_size)
+    parser.add_argument('--server', choices=('http', 'asyncio'), default='http')
+    parser.add_argument('--download-engine', choices=('pool', 'ranges'), default='pool')
+    parser.add_argument('--download-connections', type=int, default=8)
+    parser.add_argument('--pipeline', action='store_true')
+    parser.add_argument('--keep-raw', action='store_true')
+    parser.add_argument('--result-formats', type=parse_formats, default=['json'])
+    parser.add_argument('--compress-results', action='store_true')
+    parser.add_argument('--cache-size', type=parse_size, default=0)
+    parser.add_argument('--work-dir')
+    parser.add_argument('--job-ttl', type=float, default=3600)
+    parser.add_argument('--job-index')
+    parser.add_argument('--small-job-size', type=parse_size, default=10 * 1024 * 1024)
+    parser.add_argument('--peers', type=parse_peers, default=[])
+    parser.add_argument('--advertise-url')
+    parser.add_argument('--drain-timeout', type=float, default=30)
+    parser.add_argument('--profile')
+    parser.add_argument('--profiler', choices=PROFILERS, default='cprofile')
+    return parser.parse_args()
+
+
+def create_sort_backend(name: str, budget: int) -> SortBackend:
+    if name == 'processes':
+        return ProcessSortBackend(budget)
+    return ThreadSortBackend(budget)
+
+
+def create_profiler(name: str, path: str) -> Profiler:
+    if name == 'sampling':
+        return SamplingProfiler(path)
+    return CallProfiler(path)
 
 
 def run():
-    worker_count, max_concurrency = parse_args()
-    with TemporaryDirectory() as work_dir:
-        logger.info('Temporary directory is %s', work_dir)
-        downloader = DataDownloader(work_dir, worker_count)
-        master = BackgroundMaster(JobValidator(max_concurrency), downloader, DataReader(work_dir), DataWriter(work_dir))
-        server = CustomServer(LISTEN_ADDRESS, RequestHandler, on_new_job=master.add_job,
-                              on_get_job_status=master.get_job_status)
-        master.start(worker_count)
+    args = parse_args()
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+    with nullcontext(args.work_dir) if args.work_dir else TemporaryDirectory() as work_dir:
+        logger.info('Work directory is %s', work_dir)
+        if args.download_engine == 'ranges':
+            downloader = RangeDataDownloader(work_dir, args.download_connections)
+        else:
+            downloader = DataDownloader(work_dir, args.workers)
+        sort_backend = create_sort_backend(args.sort_backend, args.sort_budget)
+        sorter_factory = DataSorterFactory(sort_backend, None if args.sort_kernel == 'auto' else args.sort_kernel)
+        external_sorter = ExternalSorter(work_dir, args.max_sort_memory) if args.max_sort_memory else None
+        reader = DataReader(work_dir)
+        pipeline = DataPipeline(work_dir, downloader, reader, args.keep_raw) if args.pipeline else None
+        writer = DataWriter(work_dir, args.result_formats, args.compress_results)
+        cache = ResultCache(args.cache_size) if args.cache_size else None
+        cluster = None
+        if args.peers:
+            cluster = ClusterSorter(work_dir, args.peers, args.advertise_url or 'http://localhost:%s' % args.port)
+        processor = JobProcessor(downloader, reader, writer, sorter_factory, external_sorter, pipeline, cache, cluster)
+        jobs = JobStore(args.job_ttl, args.job_index, processor.cleanup)
+        coalescer = JobCoalescer() if cache else None
+        scheduler = JobScheduler(downloader, args.small_job_size)
+        profiler = create_profiler(args.profiler, args.profile) if args.profile else Profiler()
+        master = BackgroundMaster(JobValidator(args.max_concurrency), processor, jobs, scheduler, coalescer, Metrics())
+        api = JobApi(on_new_job=master.add_job, on_get_job_status=master.get_job_status, on_get_stats=master.get_stats,
+                     on_get_partition=cluster and cluster.get_partition, on_get_metrics=master.get_metrics,
+                     on_stream_result=master.stream_result, profiler=profiler, on_new_jobs=master.add_jobs,
+                     on_watch_job=master.watch_job)
+        address = (LISTEN_HOST, args.port)
+        if args.server == 'asyncio':
+            server = AsyncServer(address, api)
+        else:
+            server = CustomServer(address, RequestHandler, api=api)
+        queue_path = os.path.join(args.work_dir, QUEUE_FILE_NAME) if args.work_dir else None
+
+        def drain():
+            master.drain(args.drain_timeout, queue_path)
+            server.shutdown()
+        signal.signal(signal.SIGTERM, lambda signum, frame: Thread(target=drain, daemon=True).start())
+        master.start(args.workers)
+        profiler.start()
+        if queue_path:
+            master.resume(queue_path)
+        for component in (downloader, sort_backend):
+            Thread(target=component.warm_up, daemon=True).start()
         try:
             server.serve_forever()
         finally:
+            profiler.stop()
             master.stop()
             downloader.stop()
+            sort_backend.stop()
+            jobs.close()
 
 
 if __name__ == '__main__':
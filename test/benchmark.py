@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+from argparse import ArgumentParser, Namespace
+from io import BytesIO
+from random import randint
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep, monotonic
+from typing import Iterable, List, Callable, Dict, Optional
+from urllib.request import urlopen
+
+from lib.common import merge_int_iterables, quick_sort, logger
+from lib.data import DataReader, DataWriter, DataSorter
+from test_server import DISTRIBUTIONS, generate_numbers, get_numbers_body
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = ('quick_sort', 'merge', 'read', 'sort', 'write', 'pipeline')
+ORIGIN_PORT = 8897
+SERVER_PORT = 8898
+POLL_INTERVAL = 0.005
+
+
+def linear_merge_int_iterables(parts: Iterable[Iterable[int]]) -> Iterable[int]:
+    def pair(numbers):
+        iterator = iter(numbers)
+        return [next(iterator), iterator]
+    pairs = list(map(pair, parts))
+    while pairs:
+        min_index = None
+        min_value = float('Inf')
+        for i, (value, _) in enumerate(pairs):
+            if value < min_value:
+                min_index = i
+                min_value = value
+        try:
+            pairs[min_index][0] = next(pairs[min_index][1])
+        except StopIteration:
+            del pairs[min_index]
+        yield min_value
+
+
+def generate_parts(k: int, n: int) -> List[List[int]]:
+    size = max(n // k, 1)
+    return [sorted(randint(-n, n) for _ in range(size)) for _ in range(k)]
+
+
+def measure(run: Callable[[], Optional[Iterable]], repeat: int) -> float:
+    best = float('Inf')
+    for _ in range(repeat):
+        started_at = perf_counter()
+        result = run()
+        if result is not None:
+            for _ in result:
+                pass
+        best = min(best, perf_counter() - started_at)
+    return best
+
+
+def wait_for_port(port: int, timeout: float=10):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return
+        except OSError:
+            sleep(0.1)
+    raise RuntimeError('port %s is not listening' % port)
+
+
+def parse_server_timing(value: str) -> Dict[str, float]:
+    result = {}
+    for item in filter(None, map(str.strip, (value or '').split(','))):
+        name, _, duration = item.partition(';dur=')
+        result[name] = float(duration) / 1000
+    return result
+
+
+class Pipeline:
+
+    def __init__(self, workers: int, server_args: List[str]):
+        commands = [[sys.executable, 'test/test_server.py', str(ORIGIN_PORT)],
+                    [sys.executable, 'main.py', '--workers', str(workers), '--port', str(SERVER_PORT)] + server_args]
+        self._processes = [subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                           for command in commands]
+        for port in (ORIGIN_PORT, SERVER_PORT):
+            wait_for_port(port)
+
+    def stop(self):
+        for process in self._processes:
+            process.kill()
+            process.wait()
+
+    def run(self, distribution: str, size: int, concurrency: int) -> Dict[str, float]:
+        url = 'http://localhost:%s/numbers/%s/%s' % (ORIGIN_PORT, distribution, size)
+        started_at = perf_counter()
+        with urlopen('http://localhost:%s/?concurrency=%s&sort=%s' % (SERVER_PORT, concurrency, url)) as response:
+            job_id = json.load(response)['jobid']
+        while True:
+            with urlopen('http://localhost:%s/?get=%s' % (SERVER_PORT, job_id)) as response:
+                timing = response.headers.get('Server-Timing')
+                payload = json.load(response)
+            if payload['state'] == 'ready':
+                break
+            if payload['state'] == 'error':
+                raise RuntimeError('job %s failed: %s' % (job_id, payload['data']))
+            sleep(POLL_INTERVAL)
+        result = dict(seconds=perf_counter() - started_at)
+        result.update(('server_%s' % name, seconds) for name, seconds in parse_server_timing(timing).items())
+        return result
+
+
+def run_benchmarks(args: Namespace) -> List[dict]:
+    results = []
+
+    def record(benchmark, **values):
+        results.append(dict(benchmark=benchmark, **values))
+        print(' '.join('%s=%s' % (key, '%.4f' % value if isinstance(value, float) else value)
+                       for key, value in results[-1].items()), flush=True)
+
+    with TemporaryDirectory() as work_dir:
+        writer = DataWriter(work_dir, args.formats)
+        for size in args.sizes:
+            if 'merge' in args.benchmarks:
+                for k in args.k:
+                    parts = generate_parts(k, size)
+                    linear = measure(lambda: linear_merge_int_iterables(parts), args.repeat)
+                    heap = measure(lambda: merge_int_iterables(parts), args.repeat)
+                    record('merge', size=size, k=k, seconds=heap, speedup=linear / heap)
+            for distribution in args.distributions:
+                numbers = generate_numbers(distribution, size)
+                if 'quick_sort' in args.benchmarks:
+                    record('quick_sort', distribution=distribution, size=size,
+                           seconds=measure(lambda: quick_sort(list(numbers)), args.repeat))
+                if 'read' in args.benchmarks:
+                    body = get_numbers_body(distribution, size)
+                    record('read', distribution=distribution, size=size,
+                           seconds=measure(lambda: DataReader(work_dir)._read_from_file(BytesIO(body)), args.repeat))
+                if 'write' in args.benchmarks:
+                    ordered = sorted(numbers)
+                    record('write', distribution=distribution, size=size,
+                           seconds=measure(lambda: writer.write('benchmark.json', ordered), args.repeat))
+                if 'sort' in args.benchmarks:
+                    for concurrency in args.concurrency:
+                        with DataSorter(concurrency) as sorter:
+                            record('sort', distribution=distribution, size=size, concurrency=concurrency,
+                                   seconds=measure(lambda: sorter.sort(numbers), args.repeat))
+    if 'pipeline' in args.benchmarks:
+        pipeline = Pipeline(args.workers, args.server_args.split())
+        try:
+            for size in args.sizes:
+                for distribution in args.distributions:
+                    for concurrency in args.concurrency:
+                        runs = [pipeline.run(distribution, size, concurrency) for _ in range(args.repeat)]
+                        best = min(runs, key=lambda run: run['seconds'])
+                        record('pipeline', distribution=distribution, size=size, concurrency=concurrency, **best)
+        finally:
+            pipeline.stop()
+    return results
+
+
+def make_key(result: dict) -> str:
+    return ' '.join('%s=%s' % (key, result[key])
+                    for key in ('benchmark', 'distribution', 'size', 'k', 'concurrency') if key in result)
+
+
+def compare(results: List[dict], baseline: List[dict], threshold: float) -> List[str]:
+    baseline = dict((make_key(result), result['seconds']) for result in baseline)
+    regressions = []
+    print('%-60s %10s %10s %8s' % ('benchmark', 'baseline', 'current', 'change'))
+    for result in results:
+        key = make_key(result)
+        if key not in baseline:
+            continue
+        change = result['seconds'] / baseline[key] - 1
+        result['baseline'] = baseline[key]
+        flag = ''
+        if change > threshold:
+            regressions.append(key)
+            flag = ' REGRESSION'
+        print('%-60s %10.4f %10.4f %+7.1f%%%s' % (key, baseline[key], result['seconds'], change * 100, flag))
+    return regressions
+
+
+def parse_int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(',')]
+
+
+def parse_choices(choices: Iterable[str]) -> Callable[[str], List[str]]:
+    def parse(value: str) -> List[str]:
+        items = [item.strip() for item in value.split(',')]
+        unknown = set(items) - set(choices)
+        if unknown:
+            raise ValueError('unknown items: %s' % ', '.join(sorted(unknown)))
+        return items
+    return parse
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument('--benchmarks', type=parse_choices(BENCHMARKS), default=list(BENCHMARKS[:-1]))
+    parser.add_argument('--distributions', type=parse_choices(DISTRIBUTIONS), default=list(DISTRIBUTIONS))
+    parser.add_argument('--sizes', type=parse_int_list, default=[10000, 100000])
+    parser.add_argument('--concurrency', type=parse_int_list, default=[1, 4])
+    parser.add_argument('--k', type=parse_int_list, default=[2, 8, 50, 500])
+    parser.add_argument('--formats', type=parse_choices(('json', 'int64', 'delta')), default=['json'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--server-args', default='')
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logger.setLevel(logging.WARNING)
+    results = run_benchmarks(args)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)['results'], args.threshold)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(dict(python=platform.python_version(), machine=platform.machine(), cpus=os.cpu_count(),
+                           args=dict((key, value) for key, value in vars(args).items()
+                                     if key not in ('output', 'baseline')),
+                           results=results), file, indent=2)
+    if regressions:
+        print('%s benchmarks regressed by more than %d%%' % (len(regressions), args.threshold * 100))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
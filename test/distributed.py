@@ -0,0 +1,74 @@
+import os
+import socket
+import subprocess
+import sys
+from random import Random
+from time import sleep, monotonic
+
+import pytest
+import requests
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ORIGIN_PORT = 8899
+COORDINATOR_PORT = 8900
+PEER_PORTS = (8901, 8902, 8903)
+
+
+def wait_for_port(port, timeout=10):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return
+        except OSError:
+            sleep(0.1)
+    raise RuntimeError('port %s is not listening' % port)
+
+
+@pytest.fixture(scope='module')
+def cluster():
+    commands = [[sys.executable, 'test/test_server.py', str(ORIGIN_PORT)]]
+    commands.extend([sys.executable, 'main.py', '--workers', '2', '--port', str(port), '--result-formats', 'int64']
+                    for port in PEER_PORTS)
+    commands.append([sys.executable, 'main.py', '--workers', '2', '--port', str(COORDINATOR_PORT), '--peers',
+                     ','.join('http://localhost:%s' % port for port in PEER_PORTS)])
+    processes = [subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                 for command in commands]
+    try:
+        for port in (ORIGIN_PORT, COORDINATOR_PORT) + PEER_PORTS:
+            wait_for_port(port)
+        yield 'http://localhost:%s' % COORDINATOR_PORT
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+
+
+def sort_on(coordinator, url, timeout=30):
+    job_id = requests.get(coordinator, params=dict(concurrency=2, sort=url)).json()['jobid']
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        result = requests.get(coordinator, params=dict(get=job_id)).json()
+        if result['state'] in ('ready', 'error'):
+            return result
+        sleep(0.2)
+    raise TimeoutError(job_id)
+
+
+def test_distributed_sort(cluster):
+    result = sort_on(cluster, 'http://localhost:%s/ranges/100000' % ORIGIN_PORT)
+    random = Random(100000)
+    assert result == dict(state='ready', data=sorted(random.randint(-10 ** 6, 10 ** 6) for _ in range(100000)))
+
+
+def test_distributed_sort_with_few_numbers(cluster):
+    result = sort_on(cluster, 'http://localhost:%s/amount/2' % ORIGIN_PORT)
+    assert result['state'] == 'ready'
+    assert len(result['data']) == 2 and result['data'] == sorted(result['data'])
+
+
+def test_distributed_sort_if_incorrect_data(cluster):
+    result = sort_on(cluster, 'http://localhost:%s/incorrect' % ORIGIN_PORT)
+    assert result['state'] == 'error'
+    assert result['data'] == 'incorrect data'
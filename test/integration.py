@@ -71,3 +71,48 @@ def test_if_number_amount_greater_than_concurrency():
     assert result['data'] is not None
     assert len(result['data']) == 1000
     assert result['data'] == sorted(result['data'])
+
+
+def test_batch_submit_and_long_poll():
+    jobs = [dict(concurrency=2, url='http://localhost:8889/amount/10'), dict(concurrency=0, url='hello')]
+    job_ids = requests.post('http://localhost:8888/batch', json=jobs).json()['jobids']
+    assert len(job_ids) == 2
+    result = requests.get('http://localhost:8888?get=%s&wait=10' % job_ids[0]).json()
+    assert result['state'] == 'ready'
+    assert len(result['data']) == 10
+    result = requests.get('http://localhost:8888?get=%s&wait=10' % job_ids[1]).json()
+    assert result['state'] == 'error'
+    assert result['data'] == 'concurrency must be positive'
+
+
+def test_stream_result_while_job_is_running():
+    url = 'http://localhost:8889/numbers/uniform/300000'
+    job_id = requests.get('http://localhost:8888?concurrency=2&sort=%s' % url).json()['jobid']
+    result = requests.get('http://localhost:8888?get=%s' % job_id).json()
+    if result['state'] == 'progress' and 'progress' in result:
+        assert 0 <= result['progress']['fraction'] <= 1
+    result = requests.get('http://localhost:8888?get=%s&stream=1' % job_id).json()
+    assert result['state'] == 'ready'
+    assert len(result['data']) == 300000
+    assert result['data'] == sorted(result['data'])
+
+
+@pytest.mark.parametrize('query', ('top=5', 'top=-5', 'range=-1000:1000', 'quantiles=0.5,0.99'))
+def test_query_modes(query):
+    url = 'http://localhost:8889/amount/1000'
+    job_id = requests.get('http://localhost:8888?concurrency=2&sort=%s&%s' % (url, query)).json()['jobid']
+    result = requests.get('http://localhost:8888?get=%s&wait=10' % job_id).json()
+    assert result['state'] == 'ready'
+    assert result['data'] == sorted(result['data'])
+    if query.startswith('top'):
+        assert len(result['data']) == 5
+    if query.startswith('quantiles'):
+        assert len(result['data']) == 2
+
+
+def test_gzip_source_with_unique_numbers():
+    url = 'http://localhost:8889/gzip/duplicates/100000'
+    job_id = requests.get('http://localhost:8888?concurrency=2&sort=%s&unique=1' % url).json()['jobid']
+    result = requests.get('http://localhost:8888?get=%s&wait=10' % job_id).json()
+    assert result['state'] == 'ready'
+    assert result['data'] == list(range(-10, 11))
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import platform
+import pstats
+import signal
+import subprocess
+import sys
+from argparse import ArgumentParser, Namespace
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPException
+from math import ceil
+from random import Random
+from threading import Lock, Thread, local
+from time import perf_counter, sleep
+from typing import Dict, List, Optional, Tuple
+
+from lib.profiler import PROFILERS
+from benchmark import ROOT, wait_for_port, parse_choices, parse_int_list
+from test_server import DISTRIBUTIONS, ThreadingSimpleServer, RequestHandler
+
+
+ENDPOINTS = ('submit', 'batch', 'poll', 'stats', 'metrics')
+ORIGIN_PORT = 8895
+SERVER_PORT = 8896
+DRAIN_TIMEOUT = 5
+STOP_TIMEOUT = 30
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for item in filter(None, map(str.strip, value.split(','))):
+        name, _, weight = item.partition('=')
+        if name not in ENDPOINTS:
+            raise ValueError('unknown endpoint %s' % name)
+        mix[name] = int(weight or 1)
+    if not any(mix.values()):
+        raise ValueError('mix is empty')
+    return mix
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(int(ceil(fraction * len(ordered))) - 1, 0)]
+
+
+class Client:
+
+    def __init__(self, host: str, port: int, timeout: float):
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._local = local()
+
+    def request(self, method: str, path: str, body: Optional[bytes]=None) -> Tuple[int, bytes]:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = HTTPConnection(self._host, self._port, timeout=self._timeout)
+        try:
+            connection.request(method, path, body, {'Content-Type': 'application/json'} if body else {})
+            response = connection.getresponse()
+            return response.status, response.read()
+        except (OSError, HTTPException):
+            connection.close()
+            self._local.connection = None
+            raise
+
+
+class Recorder:
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+        self._lock = Lock()
+
+    def record(self, endpoint: str, seconds: float, status: int):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            self.statuses[endpoint][status] += 1
+
+    def summarize(self, elapsed: float) -> List[dict]:
+        results = []
+        for endpoint in sorted(self.latencies) + ['total']:
+            if endpoint == 'total':
+                latencies = [seconds for values in self.latencies.values() for seconds in values]
+                statuses = sum(self.statuses.values(), Counter())
+            else:
+                latencies = self.latencies[endpoint]
+                statuses = self.statuses[endpoint]
+            errors = sum(count for status, count in statuses.items() if not 200 <= status < 400)
+            results.append(dict(endpoint=endpoint, requests=len(latencies), rps=len(latencies) / elapsed,
+                                p50=percentile(latencies, 0.5), p99=percentile(latencies, 0.99),
+                                max=max(latencies, default=0.0), errors=errors,
+                                error_rate=errors / len(latencies) if latencies else 0.0,
+                                statuses=dict((str(status), count) for status, count in sorted(statuses.items()))))
+        return results
+
+
+class LoadGenerator:
+
+    def __init__(self, client: Client, origin_url: str, args: Namespace):
+        self._client = client
+        self._origin_url = origin_url
+        self._args = args
+        self._random = Random(args.seed)
+        self._job_ids: List[str] = []
+
+    def run(self) -> Tuple[Recorder, float]:
+        self._submit_seed_job()
+        recorder = Recorder()
+        endpoints, weights = zip(*self._args.mix.items())
+        plan = self._random.choices(endpoints, weights, k=int(self._args.rps * self._args.duration))
+        started_at = perf_counter()
+        with ThreadPoolExecutor(self._args.connections) as executor:
+            for i, endpoint in enumerate(plan):
+                scheduled_at = started_at + i / self._args.rps
+                delay = scheduled_at - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+                executor.submit(self._send, endpoint, self._build(endpoint), scheduled_at, recorder)
+        return recorder, perf_counter() - started_at
+
+    def _submit_seed_job(self):
+        status, body = self._client.request(*self._build('submit'))
+        if status != 200:
+            raise RuntimeError('seed job is rejected with %s: %s' % (status, body.decode()))
+        self._remember('submit', body)
+
+    def _build(self, endpoint: str) -> Tuple[str, str, Optional[bytes]]:
+        if endpoint == 'submit':
+            return 'GET', '/?concurrency=%s&sort=%s' % (self._args.concurrency, self._get_source()), None
+        if endpoint == 'batch':
+            jobs = [dict(concurrency=self._args.concurrency, url=self._get_source())
+                    for _ in range(self._args.batch_size)]
+            return 'POST', '/batch', json.dumps(dict(jobs=jobs)).encode()
+        if endpoint == 'poll':
+            return 'GET', '/?get=%s' % self._random.choice(self._job_ids), None
+        if endpoint == 'stats':
+            return 'GET', '/?stats=1', None
+        return 'GET', '/metrics', None
+
+    def _get_source(self) -> str:
+        return '%s/numbers/%s/%s' % (self._origin_url, self._random.choice(self._args.distributions),
+                                     self._random.choice(self._args.sizes))
+
+    def _send(self, endpoint: str, request: Tuple[str, str, Optional[bytes]], scheduled_at: float,
+              recorder: Recorder):
+        try:
+            status, body = self._client.request(*request)
+        except (OSError, HTTPException):
+            status, body = 0, b''
+        recorder.record(endpoint, perf_counter() - scheduled_at, status)
+        if status == 200:
+            self._remember(endpoint, body)
+
+    def _remember(self, endpoint: str, body: bytes):
+        if endpoint == 'submit':
+            self._job_ids.append(json.loads(body)['jobid'])
+        elif endpoint == 'batch':
+            self._job_ids.extend(json.loads(body)['jobids'])
+
+
+class Server:
+
+    def __init__(self, args: Namespace):
+        command = [sys.executable, 'main.py', '--workers', str(args.workers), '--port', str(SERVER_PORT),
+                   '--drain-timeout', str(DRAIN_TIMEOUT)] + args.server_args.split()
+        if args.profile:
+            command += ['--profile', os.path.abspath(args.profile), '--profiler', args.profiler]
+        self._process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(SERVER_PORT)
+
+    def stop(self):
+        self._process.send_signal(signal.SIGTERM)
+        try:
+            self._process.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+
+
+class QuietRequestHandler(RequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def start_origin(port: int) -> ThreadingSimpleServer:
+    origin = ThreadingSimpleServer(('', port), QuietRequestHandler)
+    Thread(target=origin.serve_forever, daemon=True).start()
+    return origin
+
+
+def print_results(results: List[dict]):
+    print('%-10s %8s %8s %10s %10s %10s %8s' % ('endpoint', 'requests', 'rps', 'p50 ms', 'p99 ms', 'max ms', 'errors'))
+    for result in results:
+        print('%-10s %8d %8.1f %10.2f %10.2f %10.2f %7.2f%%' % (
+            result['endpoint'], result['requests'], result['rps'], result['p50'] * 1000, result['p99'] * 1000,
+            result['max'] * 1000, result['error_rate'] * 100))
+
+
+def print_profile(path: str, profiler: str, top: int):
+    if not os.path.exists(path):
+        print('profile %s is not written' % path)
+        return
+    if profiler == 'cprofile':
+        pstats.Stats(path).sort_stats('cumulative').print_stats(top)
+        return
+    leaves = Counter()
+    with open(path) as file:
+        for line in file:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            leaves[stack.rsplit(';', 1)[-1]] += int(count)
+    total = sum(leaves.values()) or 1
+    for frame, count in leaves.most_common(top):
+        print('%6.2f%% %6d %s' % (count * 100 / total, count, frame))
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument('--mix', type=parse_mix, default=dict(submit=1, poll=8, stats=1))
+    parser.add_argument('--rps', type=float, default=100)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--connections', type=int, default=16)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--distributions', type=parse_choices(DISTRIBUTIONS), default=list(DISTRIBUTIONS))
+    parser.add_argument('--sizes', type=parse_int_list, default=[1000, 10000])
+    parser.add_argument('--concurrency', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--server-args', default='')
+    parser.add_argument('--profile')
+    parser.add_argument('--profiler', choices=PROFILERS, default='cprofile')
+    parser.add_argument('--profile-top', type=int, default=20)
+    parser.add_argument('--output')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    origin = start_origin(ORIGIN_PORT)
+    server = Server(args)
+    try:
+        client = Client('localhost', SERVER_PORT, args.timeout)
+        recorder, elapsed = LoadGenerator(client, 'http://localhost:%s' % ORIGIN_PORT, args).run()
+    finally:
+        server.stop()
+        origin.shutdown()
+    results = recorder.summarize(elapsed)
+    print_results(results)
+    if args.profile:
+        print_profile(args.profile, args.profiler, args.profile_top)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(dict(python=platform.python_version(), machine=platform.machine(), cpus=os.cpu_count(),
+                           args=dict((key, value) for key, value in vars(args).items() if key != 'output'),
+                           elapsed=elapsed, results=results), file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
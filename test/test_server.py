@@ -1,17 +1,62 @@
 #!/usr/bin/env python3
 
+import gzip
+import re
+import sys
+from functools import lru_cache
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from random import randint
+from random import randint, Random
 from socketserver import ThreadingMixIn
 from time import sleep
 
 
+DISTRIBUTIONS = ('uniform', 'sorted', 'reverse', 'duplicates')
+
+
+def generate_numbers(distribution, count, seed=0):
+    random = Random('%s:%s:%s' % (distribution, count, seed))
+    if distribution == 'duplicates':
+        return [random.randint(-10, 10) for _ in range(count)]
+    numbers = [random.randint(-10 ** 9, 10 ** 9) for _ in range(count)]
+    if distribution == 'sorted':
+        numbers.sort()
+    elif distribution == 'reverse':
+        numbers.sort(reverse=True)
+    elif distribution != 'uniform':
+        raise ValueError('unknown distribution %s' % distribution)
+    return numbers
+
+
+@lru_cache(maxsize=8)
+def get_numbers_body(distribution, count):
+    return ','.join(map(str, generate_numbers(distribution, count))).encode()
+
+
+@lru_cache(maxsize=8)
+def get_gzip_body(distribution, count):
+    return gzip.compress(get_numbers_body(distribution, count))
+
+
 class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+
+    daemon_threads = True
 
 
 class RequestHandler(BaseHTTPRequestHandler):
 
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        if self.path.startswith('/ranges'):
+            self._send_ranges(self._get_ranges_body(), False)
+        elif self.path.startswith('/numbers'):
+            self._send_numbers(False)
+        elif self.path.startswith('/gzip'):
+            self._send_gzip(False)
+        else:
+            self._send_headers(200 if self.path in ('/slow', '/empty', '/incorrect') or
+                               self.path.startswith('/amount') else 404)
+
     def do_GET(self):
         if self.path == '/slow':
             sleep(3)
@@ -23,16 +68,73 @@ class RequestHandler(BaseHTTPRequestHandler):
         elif self.path.startswith('/amount'):
             count = int(self.path.rsplit('/', 1)[1])
             self._send_response(randint(-1000, 1000) for _ in range(count))
+        elif self.path.startswith('/ranges'):
+            self._send_ranges(self._get_ranges_body(), True)
+        elif self.path.startswith('/numbers'):
+            self._send_numbers(True)
+        elif self.path.startswith('/gzip'):
+            self._send_gzip(True)
         else:
             self._send_response([], 404)
 
-    def _send_response(self, numbers, status=200):
+    def _get_ranges_body(self):
+        count = int(self.path.rsplit('/', 1)[1])
+        random = Random(count)
+        return ', '.join(str(random.randint(-10 ** 6, 10 ** 6)) for _ in range(count)).encode()
+
+    def _send_numbers(self, with_body):
+        match = re.match(r'/numbers/(\w+)/(\d+)$', self.path)
+        if not match or match.group(1) not in DISTRIBUTIONS:
+            self._send_response([], 404)
+            return
+        self._send_ranges(get_numbers_body(match.group(1), int(match.group(2))), with_body)
+
+    def _send_gzip(self, with_body):
+        match = re.match(r'/gzip/(\w+)/(\d+)$', self.path)
+        if not match or match.group(1) not in DISTRIBUTIONS:
+            self._send_response([], 404)
+            return
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = get_gzip_body(match.group(1), int(match.group(2)))
+            self.send_header('Content-Encoding', 'gzip')
+        else:
+            body = get_numbers_body(match.group(1), int(match.group(2)))
+        self.send_header('Content-Type', 'plain/text')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def _send_ranges(self, body, with_body):
+        match = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+        if match:
+            start, end = int(match.group(1)), min(int(match.group(2)), len(body) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, len(body)))
+            body = body[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"%s"' % len(body))
+        self.send_header('Content-Type', 'plain/text')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def _send_headers(self, status):
         self.send_response(status)
         self.send_header('Content-Type', 'plain/text')
+        self.send_header('Connection', 'close')
         self.end_headers()
+        self.close_connection = True
+
+    def _send_response(self, numbers, status=200):
+        self._send_headers(status)
         self.wfile.write(', '.join(map(str, numbers)).encode())
 
 
 if __name__ == '__main__':
-    server = ThreadingSimpleServer(('', 8889), RequestHandler)
+    server = ThreadingSimpleServer(('', int(sys.argv[1]) if len(sys.argv) > 1 else 8889), RequestHandler)
     server.serve_forever()
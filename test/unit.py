@@ -1,24 +1,63 @@
+import gzip
+import json
+import logging
+import os
+import pstats
+import socket
+import weakref
+import zlib
+from array import array
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.client import HTTPConnection, IncompleteRead
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+from random import randint
+from threading import Timer, Event, Thread
+from time import sleep, monotonic
+from typing import Tuple
+
 import pytest
 
-from lib.common import quick_sort, merge_int_iterables
-from lib.data import DataReader
+from lib.background import BackgroundMaster, JobValidator, JobProcessor
+from lib.cache import ResultCache
+from lib.cluster import ClusterSorter, choose_splitters
+from lib.common import CustomException, quick_sort, merge_int_iterables, SORT_KERNELS, choose_sort_kernel, \
+    encode_delta_varint, decode_delta_varint, JobStatus, Job, ServiceUnavailable, StreamInterrupted
+from lib.data import DataReader, DataSorter, ExternalSorter, DataPipeline, DataWriter, DataSorterFactory, \
+    ThreadSortBackend, ChunkSizer, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE, MAX_MERGE_WIDTH, read_response, \
+    MERGE_MEMORY_RATIO, MERGE_NUMBER_FOOTPRINT, RangeDataDownloader, RANGE_SEGMENT_SIZE
+from lib.http import Response, JobApi, CustomServer, RequestHandler, AsyncServer, accepts_encoding, \
+    choose_result_format, format_server_timing
+from lib.metrics import JobTimings, Metrics, track_job, stage, count
+from lib.profiler import CallProfiler, SamplingProfiler
+from lib.query import Query, parse_query, parse_unique, select_rank
+from lib.scheduler import JobScheduler
+from lib.store import JobStore
 
 
-@pytest.mark.parametrize('chunks, expected', (
-    (['10, 20', ''], [[10, 20]]),
-    (['10000, 200', '00, 30000', ''], [[10000], [20000], [30000]]),
-    (['10, 20, 30', ', 40', ''], [[10, 20], [30, 40]]),
+@pytest.mark.parametrize('data, expected', (
+    (b'10, 20', [[10], [20]]),
+    (b'10000, 20000, 30000', [[10000], [20000], [30000]]),
+    (b'10, 20, 30, 40', [[10, 20], [30], [40]]),
+    (b' 1,2 ,\n3\r\n, -4\n', [[1, 2], [3], [-4]]),
 ))
-def test_data_reader_read_from_file(mocker, chunks, expected):
-    file = mocker.Mock()
-    file.read.side_effect = chunks
-    result = DataReader('work_dir')._read_from_file(file, 10)
-    assert list(result) == expected
+def test_data_reader_read_from_file(data, expected):
+    result = DataReader('work_dir')._read_from_file(BytesIO(data), 10)
+    assert list(map(list, result)) == expected
+
+
+@pytest.mark.parametrize('data', (b'1, 2, ', b'1, foo', b'1,, 2', b'99999999999999999999', b' '))
+def test_data_reader_read_from_file_if_incorrect(data):
+    with pytest.raises(CustomException):
+        list(DataReader('work_dir')._read_from_file(BytesIO(data), 10))
 
 
 def test_quick_sort():
-    result = quick_sort([-1, 2, -3, -8, 11, 10, 7, 12, 1, 4, 14, 0, -7, 3, 8,
-                         13, -4, 15, -9, 6, 16, 9, 5, 5, 1, -6, -2, -10, -5, 17])
+    numbers = [-1, 2, -3, -8, 11, 10, 7, 12, 1, 4, 14, 0, -7, 3, 8,
+               13, -4, 15, -9, 6, 16, 9, 5, 5, 1, -6, -2, -10, -5, 17]
+    result = quick_sort(numbers)
+    assert numbers[:3] == [-1, 2, -3]
     assert result == [-10, -9, -8, -7, -6, -5, -4, -3, -2, -1, 0, 1, 1, 2, 3,
                       4, 5, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17]
 
@@ -31,3 +70,793 @@ def test_merge_int_iterables():
         [-3, 1, 2, 4],
     ))
     assert list(result) == [-3, 0, 1, 1, 2, 2, 2, 3, 4, 4, 5, 7, 8, 8, 11, 12]
+
+
+def test_merge_int_iterables_with_empty_parts():
+    result = merge_int_iterables(([], [3, 5], [], [1, 4], [2]))
+    assert list(result) == [1, 2, 3, 4, 5]
+
+
+def test_external_sorter_sort(tmp_path):
+    numbers = [randint(-1000, 1000) for _ in range(30000)]
+    chunks = [numbers[offset:offset + 1000] for offset in range(0, len(numbers), 1000)]
+    with DataSorter(2) as sorter:
+        result = list(ExternalSorter(str(tmp_path), 0).sort('job', chunks, sorter))
+    assert result == sorted(numbers)
+    assert not os.listdir(str(tmp_path))
+
+
+@pytest.mark.parametrize('kernel_name', ('inplace', 'timsort', 'counting'))
+def test_sort_kernels(kernel_name):
+    numbers = [randint(-50, 50) for _ in range(1000)]
+    assert SORT_KERNELS[kernel_name].sort(list(numbers)) == sorted(numbers)
+
+
+@pytest.mark.parametrize('numbers, expected', (
+    ([randint(-10, 10) for _ in range(10000)], 'counting'),
+    ([randint(-10 ** 9, 10 ** 9) for _ in range(10000)], 'timsort'),
+    ([1, 2, 1], 'timsort'),
+))
+def test_choose_sort_kernel(numbers, expected):
+    assert choose_sort_kernel(numbers).name == expected
+
+
+def test_data_sorters_share_backend():
+    numbers = [randint(-1000, 1000) for _ in range(10000)]
+    backend = ThreadSortBackend(2)
+    try:
+        results = [list(DataSorterFactory(backend).create(concurrency).sort(numbers)) for concurrency in (1, 4)]
+    finally:
+        backend.stop()
+    assert results == [sorted(numbers), sorted(numbers)]
+
+
+def test_chunk_sizer_adapts_to_size_and_sort_cost():
+    assert ChunkSizer(1024, 4, 1024 ** 3).next_size() == MIN_CHUNK_SIZE
+    assert ChunkSizer(1024 ** 4, 4, 1024 ** 4).next_size() == MAX_CHUNK_SIZE
+    sizer = ChunkSizer(None, 4, 1024 ** 3)
+    size = sizer.next_size()
+    sizer.observe(0.001)
+    assert sizer.next_size() == size * 2
+    sizer.observe(10)
+    sizer.observe(10)
+    assert sizer.next_size() == size // 2
+    sizer = ChunkSizer(MAX_MERGE_WIDTH * MAX_CHUNK_SIZE, 1, 1024 ** 4)
+    for _ in range(MAX_MERGE_WIDTH - 1):
+        sizer.consume(MIN_CHUNK_SIZE)
+    assert sizer.next_size() == MAX_CHUNK_SIZE
+
+
+@pytest.mark.parametrize('memory', (1, 1024 ** 3))
+def test_data_sorter_sort_all(memory):
+    chunks = [[randint(-1000, 1000) for _ in range(20000)] for _ in range(3)]
+    with DataSorter(2, sizer=ChunkSizer(None, 2, memory)) as sorter:
+        assert list(sorter.sort_all(chunks)) == sorted(sum(chunks, []))
+
+
+def test_data_sorters_share_merge_budget():
+    chunks = [[randint(-1000, 1000) for _ in range(20000)] for _ in range(3)]
+    backend = ThreadSortBackend(2)
+    factory = DataSorterFactory(backend)
+    memory = 100000 * MERGE_MEMORY_RATIO * MERGE_NUMBER_FOOTPRINT
+    try:
+        with factory.create(2, ChunkSizer(None, 2, memory)) as first:
+            assert isinstance(first.sort_all(chunks), list)
+            with factory.create(2, ChunkSizer(None, 2, memory)) as second:
+                numbers = second.sort_all(chunks)
+                assert not isinstance(numbers, list)
+                assert list(numbers) == sorted(sum(chunks, []))
+        with factory.create(2, ChunkSizer(None, 2, memory)) as third:
+            assert isinstance(third.sort_all(chunks), list)
+    finally:
+        backend.stop()
+
+
+def test_choose_splitters():
+    assert choose_splitters(list(range(100, 0, -1)), 4) == [26, 51, 76]
+    assert choose_splitters([], 4) == []
+
+
+def test_cluster_sorter_partitions_streamed_chunks(tmp_path):
+    numbers = [randint(-1000, 1000) for _ in range(20000)]
+    sorter = ClusterSorter(str(tmp_path), ['http://a', 'http://b', 'http://c'], 'http://localhost')
+    chunks = []
+
+    def generate_chunks():
+        for start in range(0, len(numbers), 1000):
+            assert all(chunk() is None for chunk in chunks[:-1])
+            numbers_chunk = array('q', numbers[start:start + 1000])
+            chunks.append(weakref.ref(numbers_chunk))
+            yield numbers_chunk
+
+    def fetch(peer, name):
+        with open(str(tmp_path / name)) as file:
+            return sorted(map(int, file.read().split(',')))
+    sorter._submit = lambda peer, name, concurrency: name
+    sorter._fetch = fetch
+    assert list(sorter.sort('job', generate_chunks(), 1)) == sorted(numbers)
+    assert not os.listdir(str(tmp_path))
+
+
+class BlockDownloader:
+
+    def __init__(self, blocks):
+        self._blocks = blocks
+
+    def stream_url(self, url, consume):
+        for block in self._blocks:
+            consume(block)
+
+
+def test_data_pipeline_read(tmp_path):
+    downloader = BlockDownloader([b'3, 1', b'0, -', b'2'])
+    pipeline = DataPipeline(str(tmp_path), downloader, DataReader(str(tmp_path)), keep_raw=True)
+    assert list(map(list, pipeline.read('http://example.com', 'job.raw'))) == [[3, 10], [-2]]
+    assert (tmp_path / 'job.raw').read_bytes() == b'3, 10, -2'
+
+
+class NoHeadRequestHandler(BaseHTTPRequestHandler):
+
+    def do_HEAD(self):
+        self.send_response(405)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        body = b'3, 1, 2'
+        self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_range_data_downloader_if_head_is_rejected(tmp_path):
+    origin = HTTPServer(('localhost', 0), NoHeadRequestHandler)
+    Thread(target=origin.serve_forever, daemon=True).start()
+    downloader = RangeDataDownloader(str(tmp_path), 2)
+    try:
+        downloader.download_url('http://localhost:%s/numbers' % origin.server_port, 'job.raw')
+    finally:
+        downloader.stop()
+        origin.shutdown()
+    assert (tmp_path / 'job.raw').read_bytes() == b'3, 1, 2'
+
+
+class FailingRangeRequestHandler(BaseHTTPRequestHandler):
+
+    size = 3 * RANGE_SEGMENT_SIZE
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(self.size))
+        self.end_headers()
+
+    def do_GET(self):
+        start, end = map(int, self.headers['Range'].split('=')[1].split('-'))
+        if not start:
+            self.send_error(500)
+            return
+        sleep(0.3)
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, self.size))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(b'1' * (end - start + 1))
+
+    def log_message(self, *args):
+        pass
+
+
+def test_range_data_downloader_waits_for_segments_if_one_fails(tmp_path):
+    origin = ThreadingHTTPServer(('localhost', 0), FailingRangeRequestHandler)
+    Thread(target=origin.serve_forever, daemon=True).start()
+    downloader = RangeDataDownloader(str(tmp_path), 3)
+    download_segment = downloader._download_segment
+    running = []
+
+    def track_segment(url, fd, start, end):
+        running.append(start)
+        try:
+            download_segment(url, fd, start, end)
+        finally:
+            running.remove(start)
+
+    downloader._download_segment = track_segment
+    try:
+        with pytest.raises(CustomException, match='remote error'):
+            downloader.download_url('http://localhost:%s/numbers' % origin.server_port, 'job.raw')
+        assert not running
+    finally:
+        downloader.stop()
+        origin.shutdown()
+
+
+class CountingRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    methods = []
+
+    def do_HEAD(self):
+        self._send(False)
+
+    def do_GET(self):
+        self._send(True)
+
+    def _send(self, with_body):
+        self.methods.append(self.command)
+        body = b'3, 1, 2'
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_job_headers_are_fetched_once(tmp_path):
+    origin = HTTPServer(('localhost', 0), CountingRequestHandler)
+    Thread(target=origin.serve_forever, daemon=True).start()
+    downloader = RangeDataDownloader(str(tmp_path), 2)
+    scheduler = JobScheduler(downloader, 100)
+    backend = ThreadSortBackend(1)
+    processor = JobProcessor(downloader, DataReader(str(tmp_path)), DataWriter(str(tmp_path), ['json']),
+                             DataSorterFactory(backend), cache=ResultCache(1024 * 1024))
+    try:
+        scheduler.put(Job('job', '1', 'http://localhost:%s/numbers' % origin.server_port))
+        path = processor.process(JobValidator(10).validate(scheduler.get()))
+    finally:
+        scheduler.stop()
+        backend.stop()
+        downloader.stop()
+        origin.shutdown()
+    with open(path) as file:
+        assert json.load(file)['data'] == [1, 2, 3]
+    assert CountingRequestHandler.methods == ['HEAD', 'GET']
+
+
+def test_delta_varint():
+    numbers = [-2 ** 63, -1000, -1, 0, 0, 1, 127, 128, 2 ** 40, 2 ** 63 - 1]
+    data, last = encode_delta_varint(numbers)
+    assert last == numbers[-1]
+    assert decode_delta_varint(data) == numbers
+
+
+def test_data_writer_write(tmp_path):
+    numbers = list(range(-5, 100000, 7))
+    path = DataWriter(str(tmp_path), ('json', 'int64', 'delta')).write('job.json', iter(numbers))
+    with open(path) as file:
+        assert json.load(file) == dict(state='ready', data=numbers)
+    assert array('q', (tmp_path / 'job.i64').read_bytes()).tolist() == numbers
+    assert decode_delta_varint((tmp_path / 'job.delta').read_bytes()) == numbers
+
+
+def test_data_writer_write_compressed(tmp_path):
+    numbers = [1] * 10000 + [2] * 10000
+    path = DataWriter(str(tmp_path), ('json', 'int64'), compress=True).write('job.json', iter(numbers))
+    for name in ('job.json', 'job.i64'):
+        compressed = (tmp_path / (name + '.gz')).read_bytes()
+        assert gzip.decompress(compressed) == (tmp_path / name).read_bytes()
+        assert len(compressed) < os.path.getsize(path) / 100
+
+
+class EncodedResponse(BytesIO):
+
+    def __init__(self, data, encoding):
+        super().__init__(data)
+        self.headers = {'Content-Encoding': encoding} if encoding else {}
+
+
+@pytest.mark.parametrize('encoding, encode', (
+    (None, bytes),
+    ('gzip', gzip.compress),
+    ('deflate', zlib.compress),
+))
+def test_read_response_decodes_content(encoding, encode):
+    data = b', '.join(b'%d' % (number % 10) for number in range(100000))
+    assert b''.join(read_response(EncodedResponse(encode(data), encoding))) == data
+
+
+@pytest.mark.parametrize('data, encoding', ((gzip.compress(b'1, 2')[:-4], 'gzip'), (b'1, 2', 'gzip'), (b'', 'br')))
+def test_read_response_if_incorrect_encoding(data, encoding):
+    with pytest.raises(CustomException):
+        list(read_response(EncodedResponse(data, encoding)))
+
+
+@pytest.mark.parametrize('value, expected', (
+    ('gzip, deflate', True),
+    ('deflate;q=1.0, gzip;q=0.5', True),
+    ('gzip;q=0', False),
+    ('*', True),
+    ('identity', False),
+    ('', False),
+))
+def test_accepts_encoding(value, expected):
+    assert accepts_encoding({'accept-encoding': value}, 'gzip') == expected
+
+
+@pytest.mark.parametrize('params, accept, available, expected', (
+    ({}, None, ('json', 'int64'), 'json'),
+    ({}, 'text/plain', ('json', 'int64'), 'json'),
+    ({}, 'application/x-int64-le, application/json', ('json',), 'json'),
+    ({}, 'application/x-int64-le, application/json', ('json', 'int64'), 'int64'),
+    ({}, 'application/x-int64-le;q=0, */*', ('json', 'int64'), 'json'),
+    ({}, 'application/json;q=0.5, application/x-delta-varint', ('json', 'delta'), 'delta'),
+    ({}, '*/*;q=0.9, application/x-int64-le;q=0.5', ('json', 'int64'), 'json'),
+    ({}, '*/*, application/x-int64-le', ('json', 'int64'), 'int64'),
+    ({'format': 'delta'}, 'application/json', ('json',), 'delta'),
+    ({'format': 'xml'}, None, ('json',), None),
+))
+def test_choose_result_format(params, accept, available, expected):
+    headers = {'accept': accept} if accept else {}
+    assert choose_result_format(params, headers, available) == expected
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    paths = []
+    for name in ('a', 'b', 'c'):
+        path = tmp_path / ('%s.json' % name)
+        path.write_bytes(b'x' * 10)
+        paths.append(str(path))
+    cache = ResultCache(25)
+    cache.put('http://a', 'v1', paths[0])
+    cache.put('http://b', 'v1', paths[1])
+    assert cache.get('http://a', 'v1') == paths[0]
+    cache.put('http://c', 'v1', paths[2])
+    assert cache.get('http://b', 'v1') is None
+    assert not os.path.exists(paths[1])
+    assert cache.get('http://a', 'v2') is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_job_store_persists_final_statuses(tmp_path):
+    index_path = str(tmp_path / 'jobs.sqlite')
+    store = JobStore(3600, index_path)
+    store['queued'] = JobStatus.queued()
+    store['ready'] = JobStatus.ready('/result.json')
+    store.close()
+    store = JobStore(3600, index_path)
+    assert store.get('queued') is None
+    assert store['ready'].state == 'ready'
+    assert store['ready'].data == '/result.json'
+
+
+def test_job_store_expires_final_statuses(monkeypatch):
+    monkeypatch.setattr('lib.store.EXPIRE_INTERVAL', 0)
+    expired = []
+    store = JobStore(0, on_expire=lambda job_id, status: expired.append(job_id))
+    store['progress'] = JobStatus.progress()
+    store['error'] = JobStatus.error('remote error')
+    assert store.get('error') is None
+    assert store.get('progress').state == 'progress'
+    assert expired == ['error']
+
+
+def test_job_store_wait_is_woken_by_final_status():
+    store = JobStore(60)
+    store['job'] = JobStatus.progress()
+    Timer(0.05, store.__setitem__, ('job', JobStatus.ready('/tmp/job.json'))).start()
+    started_at = monotonic()
+    assert store.wait('job', 5).state == 'ready'
+    assert monotonic() - started_at < 1
+    assert store.wait('job', 5).state == 'ready'
+    store['other'] = JobStatus.queued()
+    assert store.wait('other', 0.05).state == 'queued'
+
+
+class SizedDownloader:
+
+    def head(self, url):
+        return {'Content-Length': url.rsplit('/', 1)[1]}
+
+
+def test_job_scheduler_prefers_small_jobs_and_is_fair():
+    scheduler = JobScheduler(SizedDownloader(), 100)
+    jobs = [
+        Job('large', '1', 'http://a/1000', client='a'),
+        Job('a-small', '1', 'http://a/50', client='a'),
+        Job('a-smaller', '1', 'http://a/10', client='a'),
+        Job('a-high', '1', 'http://a/90', priority='high', client='a'),
+        Job('b-small', '1', 'http://b/60', client='b'),
+    ]
+    for job in jobs:
+        scheduler.put(job)
+    scheduler.put(None)
+    while scheduler.get_depths()['estimating']:
+        sleep(0.01)
+    result = [job.id for job in iter(scheduler.get, None)]
+    scheduler.stop()
+    assert result == ['a-high', 'b-small', 'a-smaller', 'large', 'a-small']
+
+
+def test_job_timings_are_exclusive():
+    timings = JobTimings()
+    with track_job(timings):
+        with stage('merge'):
+            sleep(0.02)
+            with stage('sort'):
+                sleep(0.05)
+                count('sorted_numbers', 10)
+    assert 0.02 <= timings.durations['merge'] < 0.05
+    assert timings.durations['sort'] >= 0.05
+    result = timings.to_dict()
+    assert set(result['durations']) == {'merge', 'sort', 'total'}
+    assert result['counts'] == dict(sorted_numbers=10)
+    assert format_server_timing(result['durations']).startswith('merge;dur=')
+    metrics = Metrics()
+    metrics.observe_job(timings, 'ready')
+    text = metrics.render(dict(lanes=dict(small=2)))
+    assert 'sorter_stage_seconds_count{stage="sort"} 1' in text
+    assert 'sorter_jobs_total{state="ready"} 1' in text
+    assert 'sorter_lanes_small 2' in text
+
+
+def test_job_timings_progress():
+    timings = JobTimings()
+    assert timings.get_progress()['fraction'] == 0
+    timings.count('download_bytes', 100)
+    timings.expect('download_bytes', 100)
+    assert timings.get_progress()['fraction'] == round(1 / 3, 4)
+    timings.expect('sorted_numbers', 10)
+    timings.expect('written_numbers', 10)
+    timings.count('written_numbers', 5)
+    progress = timings.get_progress()
+    assert progress == dict(download_bytes=100, sorted_numbers=0, written_numbers=5, fraction=round(2 / 3, 4))
+
+
+class PartialResultProcessor:
+
+    def __init__(self, work_dir):
+        self._work_dir = work_dir
+
+    def get_partial_path(self, job_id):
+        return os.path.join(self._work_dir, '%s.json' % job_id)
+
+
+def test_background_master_streams_partial_result(tmp_path):
+    store = JobStore(60)
+    master = BackgroundMaster(None, PartialResultProcessor(str(tmp_path)), store, None)
+    assert master.stream_result('missing') is None
+    store['job'] = JobStatus.progress()
+    path = tmp_path / 'job.json'
+    path.write_bytes(b'{"state": "ready", "data": [1, 2')
+
+    def finish():
+        with open(str(path), 'ab') as file:
+            file.write(b', 3]}')
+        store['job'] = JobStatus.ready(str(path))
+    Timer(0.1, finish).start()
+    chunks = master.stream_result('job')
+    first = next(chunks)
+    assert first == b'{"state": "ready", "data": [1, 2'
+    assert json.loads(first + b''.join(chunks)) == dict(state='ready', data=[1, 2, 3])
+
+
+def test_background_master_interrupts_stream_of_failed_job(tmp_path):
+    store = JobStore(60)
+    master = BackgroundMaster(None, PartialResultProcessor(str(tmp_path)), store, None)
+    store['job'] = JobStatus.progress()
+    (tmp_path / 'job.json').write_bytes(b'{"state": "ready", "data": [1, 2')
+    chunks = master.stream_result('job')
+    assert next(chunks) == b'{"state": "ready", "data": [1, 2'
+    store['job'] = JobStatus.error('remote error')
+    with pytest.raises(StreamInterrupted):
+        next(chunks)
+
+
+def start_async_server(api: JobApi) -> Tuple[AsyncServer, int]:
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        port = probe.getsockname()[1]
+    server = AsyncServer(('localhost', port), api)
+    Thread(target=server.serve_forever, daemon=True).start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            break
+        except ConnectionRefusedError:
+            sleep(0.05)
+    return server, port
+
+
+def interrupted_stream(job_id, blocking=True):
+    yield b'{"state": "ready", "data": [1, 2'
+    raise StreamInterrupted('job %s is not going to finish' % job_id)
+
+
+@pytest.mark.parametrize('server_name', ('http', 'asyncio'))
+def test_servers_cut_off_interrupted_stream(caplog, server_name):
+    caplog.set_level(logging.DEBUG)
+    api = JobApi(on_new_job=None, on_get_job_status=lambda job_id, *args: JobStatus.progress(),
+                 on_stream_result=interrupted_stream)
+    if server_name == 'asyncio':
+        server, port = start_async_server(api)
+    else:
+        server = CustomServer(('localhost', 0), RequestHandler, api=api)
+        port = server.server_port
+        Thread(target=server.serve_forever, daemon=True).start()
+    connection = HTTPConnection('localhost', port, timeout=5)
+    try:
+        connection.request('GET', '/?get=job&stream=1')
+        response = connection.getresponse()
+        assert response.status == HTTPStatus.OK
+        with pytest.raises(IncompleteRead):
+            response.read()
+    finally:
+        connection.close()
+        server.shutdown()
+    assert 'Closing connection on interrupted stream: job job is not going to finish' in caplog.messages
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+
+
+def test_async_server_serves_job_api(tmp_path):
+    store = JobStore(60)
+    path = DataWriter(str(tmp_path)).write('ready.json', range(1000))
+
+    def add_job(concurrency, url, priority, client, query):
+        store['new'] = JobStatus.queued()
+        return 'new'
+
+    store['ready'] = JobStatus.ready(path)
+    api = JobApi(on_new_job=add_job, on_get_job_status=lambda job_id, wait=0: store.get(job_id))
+    server, port = start_async_server(api)
+    connection = HTTPConnection('localhost', port, timeout=5)
+    try:
+        connection.request('GET', '/?concurrency=2&sort=http://a/b')
+        assert json.loads(connection.getresponse().read()) == dict(jobid='new')
+        sock = connection.sock
+        connection.request('GET', '/?get=new')
+        assert json.loads(connection.getresponse().read()) == dict(state='queued', data=None)
+        assert connection.sock is sock
+        connection.request('GET', '/?get=ready')
+        response = connection.getresponse()
+        assert response.status == HTTPStatus.OK
+        assert json.loads(response.read()) == dict(state='ready', data=list(range(1000)))
+        connection.request('GET', '/?get=ready', headers={'Range': 'bytes=-5'})
+        response = connection.getresponse()
+        assert response.status == HTTPStatus.PARTIAL_CONTENT
+        with open(path, 'rb') as file:
+            assert response.read() == file.read()[-5:]
+        assert connection.sock is sock
+    finally:
+        connection.close()
+        server.shutdown()
+
+
+def test_async_server_waits_without_threads():
+    store = JobStore(60)
+    store['slow'] = JobStatus.progress()
+    store['fast'] = JobStatus.progress()
+    api = JobApi(on_new_job=None, on_get_job_status=lambda job_id, wait=0: store.wait(job_id, wait),
+                 on_watch_job=store.watch)
+    server, port = start_async_server(api)
+    waiters = [socket.create_connection(('localhost', port)) for _ in range(100)]
+    try:
+        for waiter in waiters:
+            waiter.sendall(b'GET /?get=slow&wait=30 HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        sleep(0.2)
+        connection = HTTPConnection('localhost', port, timeout=5)
+        Timer(0.2, store.__setitem__, ('fast', JobStatus.error('remote error'))).start()
+        started_at = monotonic()
+        connection.request('GET', '/?get=fast&wait=30')
+        assert json.loads(connection.getresponse().read()) == dict(state='error', data='remote error')
+        assert monotonic() - started_at < 2
+        connection.close()
+    finally:
+        for waiter in waiters:
+            waiter.close()
+        server.shutdown()
+
+
+def test_job_store_watch():
+    store = JobStore(60)
+    changes = []
+    unwatch = store.watch('job', lambda: changes.append(store['job'].state))
+    store['job'] = JobStatus.progress()
+    store['other'] = JobStatus.progress()
+    unwatch()
+    store['job'] = JobStatus.error('remote error')
+    assert changes == ['progress']
+
+
+@pytest.mark.parametrize('params, expected', (
+    (dict(top='3'), [-5, 0, 1]),
+    (dict(top='-2'), [8, 9]),
+    (dict(top='100'), sorted([9, -5, 3, 0, 8, 1, 3])),
+    (dict(range='1:3'), [1, 3, 3]),
+    (dict(range=':0'), [-5, 0]),
+    (dict(quantiles='0,0.5,1'), [-5, 3, 9]),
+    (dict(top='3', unique='1'), [-5, 0, 1]),
+    (dict(top='-3', unique='1'), [3, 8, 9]),
+    (dict(range='1:3', unique='1'), [1, 3]),
+))
+@pytest.mark.parametrize('external', (False, True))
+def test_query_select(tmp_path, params, expected, external):
+    chunks = [array('q', [9, -5, 3]), array('q', [0, 8]), array('q', [1, 3])]
+    external_sorter = ExternalSorter(str(tmp_path), 0) if external else None
+    with DataSorter(2) as sorter:
+        result = parse_query(params).select('job', iter(chunks), sorter, parse_unique(params), external_sorter)
+        assert list(result) == expected
+    assert not os.listdir(str(tmp_path))
+
+
+def test_quantiles_query_selects_over_spilled_runs(tmp_path):
+    numbers = [randint(-1000, 1000) for _ in range(30000)]
+    chunks = [array('q', numbers[offset:offset + 1000]) for offset in range(0, len(numbers), 1000)]
+    external_sorter = ExternalSorter(str(tmp_path), 0)
+    runs_count = []
+    open_runs = external_sorter.open_runs
+
+    def count_runs(*args):
+        with open_runs(*args) as runs:
+            runs_count.append(len(runs))
+            yield runs
+
+    external_sorter.open_runs = contextmanager(count_runs)
+    with DataSorter(2) as sorter:
+        result = parse_query(dict(quantiles='0,0.5,1')).select('job', iter(chunks), sorter, False, external_sorter)
+    ordered = sorted(numbers)
+    assert result == [ordered[0], ordered[len(ordered) // 2 - 1], ordered[-1]]
+    assert runs_count[0] > 1
+    assert not os.listdir(str(tmp_path))
+
+
+def test_query_is_abstract():
+    with pytest.raises(TypeError):
+        Query()
+
+
+@pytest.mark.parametrize('params, message', (
+    (dict(top='0'), 'top must be non-zero'),
+    (dict(top='x'), 'top must be integer'),
+    (dict(range='5'), 'range must look like a:b'),
+    (dict(range='5:1'), 'range start must not be greater than its end'),
+    (dict(quantiles='0.5,2'), 'quantiles must be up to'),
+    (dict(top='1', range='1:2'), 'only one of'),
+))
+def test_parse_query_if_invalid(params, message):
+    with pytest.raises(CustomException, match=message):
+        parse_query(params)
+
+
+def test_select_rank():
+    runs = [sorted(randint(-100, 100) for _ in range(50)) for _ in range(4)]
+    merged = sorted(sum(runs, []))
+    assert [select_rank(runs, rank) for rank in range(1, 201)] == merged
+
+
+def test_response_serves_precompressed_result(tmp_path):
+    path = DataWriter(str(tmp_path), compress=True).write('job.json', [7] * 10000)
+    response = Response.create(HTTPStatus.OK, path, {'accept-encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert response.path == path + '.gz'
+    response = Response.create(HTTPStatus.OK, path, {})
+    assert 'Content-Encoding' not in response.headers
+    assert response.path == path
+
+
+@pytest.mark.parametrize('headers, status, content_range, body', (
+    ({'range': 'bytes=2-4'}, HTTPStatus.PARTIAL_CONTENT, 'bytes 2-4/10', b'234'),
+    ({'range': 'bytes=-3'}, HTTPStatus.PARTIAL_CONTENT, 'bytes 7-9/10', b'789'),
+    ({'range': 'bytes=6-'}, HTTPStatus.PARTIAL_CONTENT, 'bytes 6-9/10', b'6789'),
+    ({'range': 'bytes=10-'}, HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, 'bytes */10', b''),
+    ({'range': 'bytes=5-3'}, HTTPStatus.OK, None, b'0123456789'),
+    ({'range': 'bytes=2-4', 'if-range': '"stale"'}, HTTPStatus.OK, None, b'0123456789'),
+    ({'range': 'bytes=2-4', 'if-range': 'ETAG'}, HTTPStatus.PARTIAL_CONTENT, 'bytes 2-4/10', b'234'),
+    ({'if-none-match': 'ETAG'}, HTTPStatus.NOT_MODIFIED, None, b''),
+    ({'if-none-match': '"stale", ETAG'}, HTTPStatus.NOT_MODIFIED, None, b''),
+    ({'if-none-match': '*'}, HTTPStatus.NOT_MODIFIED, None, b''),
+    ({'if-none-match': '"stale"'}, HTTPStatus.OK, None, b'0123456789'),
+))
+def test_response_serves_ranges_and_validators(tmp_path, headers, status, content_range, body):
+    path = str(tmp_path / 'job.json')
+    with open(path, 'wb') as file:
+        file.write(b'0123456789')
+    etag = Response.create(HTTPStatus.OK, path, {}).headers['ETag']
+    response = Response.create(HTTPStatus.OK, path, dict((key, value.replace('ETAG', etag))
+                                                         for key, value in headers.items()))
+    assert response.status == status
+    assert response.headers['ETag'] == etag
+    assert response.headers.get('Content-Range') == content_range
+    assert response.headers['Content-Length'] == str(len(body))
+    with open(path, 'rb') as file:
+        file.seek(response.offset)
+        assert (file.read(response.count) if response.path else response.body) == body
+
+
+class SlowProcessor:
+
+    def __init__(self):
+        self.started = Event()
+
+    def process(self, job):
+        self.started.set()
+        sleep(0.3)
+        return '/tmp/%s.json' % job.id
+
+
+def test_background_master_drains_and_resumes_jobs(tmp_path):
+    path = str(tmp_path / 'queue.json')
+    processor = SlowProcessor()
+    master = BackgroundMaster(JobValidator(10), processor, JobStore(60), JobScheduler(SizedDownloader(), 100))
+    master.start(1)
+    job_ids = [master.add_job('1', 'http://a/10', query=dict(top='5')) for _ in range(3)]
+    assert processor.started.wait(5)
+    assert master.drain(0.05, path)
+    assert not master.drain(0.05, path)
+    with pytest.raises(ServiceUnavailable):
+        master.add_job('1', 'http://a/10')
+    master.stop()
+    with open(path) as file:
+        assert sorted(item['id'] for item in json.load(file)) == sorted(job_ids)
+    store = JobStore(60)
+    resumed = BackgroundMaster(JobValidator(10), processor, store, JobScheduler(SizedDownloader(), 100))
+    assert resumed.resume(path) == 3
+    assert not os.path.exists(path)
+    assert [store[job_id].state for job_id in job_ids] == ['queued'] * 3
+    resumed.stop()
+
+
+class DrainingValidator(JobValidator):
+
+    def __init__(self, max_concurrency: int):
+        super().__init__(max_concurrency)
+        self.drainer = None
+
+    def validate(self, job):
+        if not self.drainer.ident:
+            self.drainer.start()
+            sleep(0.1)
+        return super().validate(job)
+
+
+def test_background_master_accepts_batch_before_drain(tmp_path):
+    path = str(tmp_path / 'queue.json')
+    validator = DrainingValidator(10)
+    master = BackgroundMaster(validator, SlowProcessor(), JobStore(60), JobScheduler(SizedDownloader(), 100))
+    validator.drainer = Thread(target=master.drain, args=(0, path))
+    api = JobApi(on_new_job=master.add_job, on_get_job_status=master.get_job_status, on_new_jobs=master.add_jobs)
+    body = json.dumps([dict(concurrency=1, url='http://a/10')] * 3).encode()
+    response = api.handle_post('/batch', {}, body)
+    validator.drainer.join(5)
+    assert response.status == HTTPStatus.OK
+    with open(path) as file:
+        assert sorted(item['id'] for item in json.load(file)) == sorted(json.loads(response.body)['jobids'])
+    assert api.handle_post('/batch', {}, body).status == HTTPStatus.SERVICE_UNAVAILABLE
+    master.stop()
+
+
+def test_call_profiler_aggregates_api_requests(tmp_path):
+    path = str(tmp_path / 'profile.out')
+    profiler = CallProfiler(path)
+    api = JobApi(on_new_job=lambda *args: 'job', on_get_job_status=lambda job_id: None, profiler=profiler)
+    for _ in range(3):
+        assert api.handle('/?concurrency=1&sort=http://a/b', {}).status == HTTPStatus.OK
+    assert api.handle('/?get=job', {}).status == HTTPStatus.NOT_FOUND
+    profiler.stop()
+    calls = dict((function[2], stat[1]) for function, stat in pstats.Stats(path).stats.items())
+    assert calls['_handle'] == 4
+    assert calls['_get_job'] == 1
+
+
+def test_sampling_profiler_samples_only_profiled_threads(tmp_path):
+    path = str(tmp_path / 'profile.txt')
+    profiler = SamplingProfiler(path, 0.001)
+    profiler.start()
+    Timer(0, sleep, (0.2,)).start()
+    with profiler.profile():
+        sleep(0.2)
+    profiler.stop()
+    with open(path) as file:
+        stacks = [line.rsplit(' ', 1)[0].split(';') for line in file]
+    assert stacks
+    assert all(any(frame.startswith('test_sampling_profiler_samples_only_profiled_threads') for frame in stack)
+               for stack in stacks)